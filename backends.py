@@ -0,0 +1,91 @@
+import logging
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+# Same fields as Firestore's FieldFilter, for the fakes when the SDK
+# isn't installed
+_FieldFilter = namedtuple("FieldFilter", ["field_path", "op_string", "value"])
+
+
+class OpenAIChat:
+    """Chat completions from the OpenAI API.
+
+    A chat backend has `complete(**request)`, taking the arguments of
+    openai.ChatCompletion.create and returning a response of the same
+    shape, and `stream(**request)`, yielding (text, finish_reason) pieces
+    of the response as they arrive. It also has the exceptions callers
+    handle: `retryable_errors` are worth retrying and `errors` is the
+    base class of all model errors.
+    """
+
+    def __init__(self):
+        import openai
+        self._openai = openai
+        self.errors = openai.error.OpenAIError
+        self.retryable_errors = (
+            openai.error.RateLimitError,
+            openai.error.APIError,
+            openai.error.Timeout,
+            openai.error.ServiceUnavailableError,
+            openai.error.APIConnectionError,
+        )
+
+    def complete(self, **request):
+        return self._openai.ChatCompletion.create(**request)
+
+    def stream(self, **request):
+        for chunk in self._openai.ChatCompletion.create(stream=True,
+                                                        **request):
+            choice = chunk["choices"][0]
+            yield (choice["delta"].get("content", ""),
+                   choice.get("finish_reason"))
+
+
+class VertexChat:
+    """Chat sessions from Vertex AI.
+
+    A review backend has `start_chat(model, context, examples)`, with
+    examples as dicts of input_text and output_text, returning a session
+    with `send_message(prompt, **parameters)` (whose response has a
+    `text` attribute) and a `message_history` list.
+    """
+
+    def __init__(self):
+        from vertexai.preview.language_models import (ChatModel,
+                                                      InputOutputTextPair)
+        self._chat_model = ChatModel
+        self._example = InputOutputTextPair
+
+    def start_chat(self, model, context=None, examples=()):
+        return self._chat_model.from_pretrained(model).start_chat(
+            context=context,
+            examples=[self._example(**example) for example in examples])
+
+
+def firestore_client():
+    """Returns a Firestore client for the application default credentials"""
+    import firebase_admin
+    from firebase_admin import credentials, firestore
+    if not firebase_admin._apps:
+        firebase_admin.initialize_app(credentials.ApplicationDefault())
+    return firestore.client()
+
+
+def field_filter(field_path, op_string, value):
+    """Returns a FieldFilter for query.where(filter=...)"""
+    try:
+        from google.cloud.firestore_v1.base_query import FieldFilter
+    except ImportError:
+        FieldFilter = _FieldFilter
+    return FieldFilter(field_path, op_string, value)
+
+
+def server_timestamp(db):
+    """Returns the sentinel that has the server fill in the write time.
+    Fakes provide their own as a SERVER_TIMESTAMP attribute."""
+    sentinel = getattr(db, "SERVER_TIMESTAMP", None)
+    if sentinel is None:
+        from firebase_admin import firestore
+        sentinel = firestore.SERVER_TIMESTAMP
+    return sentinel
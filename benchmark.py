@@ -0,0 +1,200 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+
+import fakes
+import reader
+import shards
+from pack import REPO_ROOT
+
+logger = logging.getLogger(__name__)
+
+MODES = ("trivia", "trivia_check", "trash", "congrats")
+DEFAULT_BASELINE_PATH = os.path.join(REPO_ROOT, "benchmark_baseline.json")
+DEFAULT_TODO_GLOB = os.path.join(REPO_ROOT, "en", "todo", "*.json")
+# Latency histograms reported for every mode that records them
+LATENCIES = ("llm_call_seconds", "firestore_read_seconds",
+             "firestore_write_seconds")
+
+
+def _peak_rss_mib():
+    # ru_maxrss is in KiB on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        peak //= 1024
+    return peak / 1024
+
+
+def _seed_questions(db, filenames, limit):
+    """Loads todo questions into the fake store the way ingest writes them"""
+    documents = {}
+    for filename in filenames:
+        for record in reader.iter_questions(filename):
+            if len(documents) >= limit:
+                break
+            question_obj = fakes.fix_question(record.question)
+            question_obj["content_id"] = "%s-%d" % (
+                shards.category(filename), record.line_number)
+            question_obj["correct_answer"] = question_obj["answers"][0]
+            question_obj["proofed"] = False
+            question_obj["robo_reviewed"] = False
+            documents[question_obj["content_id"]] = question_obj
+    db.preload("trivia", documents)
+    return len(documents)
+
+
+def run_mode(mode, options):
+    """Runs one mode against fresh fakes in the current process.
+
+    Meant to run in its own process, so that the peak memory belongs to
+    this mode alone.
+    Returns:
+      A dict of records, seconds, records_per_second, latency
+      percentiles and peak_rss_mib.
+    """
+
+    # imported here so fixer's log setup only applies to the worker
+    import coloredlogs
+    import fixer
+    from metrics import METRICS
+
+    coloredlogs.install(level=options["log_level"])
+    os.chdir(options["workdir"])
+    chat = fakes.FakeChat(options["chat_latency"], options["token_latency"],
+                          options["error_rate"], options["seed"])
+    db = fakes.FakeFirestore(0, options["error_rate"], options["seed"])
+    fixer.use_backends(db, chat, chat)
+    filenames = shards.expand(options["todo"])
+
+    if mode == "trivia_check":
+        _seed_questions(db, filenames, options["check_limit"])
+    db.faults.latency = options["store_latency"]
+    METRICS.reset()
+    start = time.perf_counter()
+    if mode == "trivia":
+        # --heuristics, as the baseline was recorded with the local fixes
+        args = fixer.build_parser().parse_args([
+            "--no-index", "--no-cache", "--heuristics",
+            "--concurrency", str(options["concurrency"]),
+            "--limit", str(10 ** 9)])
+        for filename in filenames:
+            args.filename = filename
+            fixer.process_file(args, None)
+        records = METRICS.counters["lines_read"]
+    elif mode == "trivia_check":
+        fixer.trivia_check("", checkpoint_file="trivia_check.checkpoint.json")
+        records = METRICS.counters["questions_checked"]
+    else:
+        fixer.banter(os.path.join(REPO_ROOT, mode + ".json"), mode)
+        records = len(db._documents("banter"))
+    seconds = time.perf_counter() - start
+
+    snapshot = METRICS.snapshot()
+    return {
+        "records": records,
+        "seconds": round(seconds, 3),
+        "records_per_second": round(records / seconds, 1) if seconds else None,
+        "latency": {
+            name: {"p50": round(snapshot["histograms"][name]["p50"], 4),
+                   "p99": round(snapshot["histograms"][name]["p99"], 4)}
+            for name in LATENCIES if name in snapshot["histograms"]},
+        "peak_rss_mib": round(_peak_rss_mib(), 1),
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Returns lines comparing results to a baseline, and whether any
+    mode got slower or bigger than `tolerance` allows"""
+    lines = []
+    regressed = False
+    for mode, result in results.items():
+        before = baseline.get("results", {}).get(mode)
+        if not before:
+            lines.append("%-14s no baseline" % mode)
+            continue
+        speed = result["records_per_second"] / before["records_per_second"]
+        memory = result["peak_rss_mib"] / before["peak_rss_mib"]
+        flags = []
+        if speed < 1 - tolerance:
+            flags.append("SLOWER")
+        if memory > 1 + tolerance:
+            flags.append("BIGGER")
+        regressed = regressed or bool(flags)
+        lines.append("%-14s %+6.1f%% records/s %+6.1f%% peak memory %s" % (
+            mode, (speed - 1) * 100, (memory - 1) * 100, " ".join(flags)))
+    return lines, regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Offline fixer.py benchmark against fake backends")
+    parser.add_argument("--modes", nargs="+", default=list(MODES),
+                        choices=MODES)
+    parser.add_argument("--todo", default=DEFAULT_TODO_GLOB,
+                        help="Question files for trivia and trivia_check")
+    parser.add_argument("--chat-latency", default=0.05, type=float,
+                        help="Seconds per fake model call")
+    parser.add_argument("--token-latency", default=0.0, type=float,
+                        help="Extra seconds per fake completion token")
+    parser.add_argument("--store-latency", default=0.005, type=float,
+                        help="Seconds per fake Firestore round trip")
+    parser.add_argument("--error-rate", default=0.0, type=float,
+                        help="""Share of fake calls that fail; retries
+                        back off randomly, so runs get noisier""")
+    parser.add_argument("--seed", default=0, type=int)
+    parser.add_argument("--concurrency", default=4, type=int)
+    parser.add_argument("--check-limit", default=2000, type=int,
+                        help="Questions to seed for trivia_check")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="Store these results as the new baseline")
+    parser.add_argument("--tolerance", default=0.2, type=float,
+                        help="Allowed slowdown/growth before failing")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    settings = {
+        "chat_latency": args.chat_latency,
+        "token_latency": args.token_latency,
+        "store_latency": args.store_latency,
+        "error_rate": args.error_rate,
+        "seed": args.seed,
+        "concurrency": args.concurrency,
+        "check_limit": args.check_limit,
+    }
+    results = {}
+    # a fresh process per mode: clean peak memory, no shared state
+    context = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory() as workdir:
+        for mode in args.modes:
+            options = dict(settings, todo=os.path.abspath(args.todo),
+                           workdir=workdir, log_level="WARNING")
+            with context.Pool(1) as pool:
+                results[mode] = pool.apply(run_mode, (mode, options))
+            print("%-14s %s" % (mode, json.dumps(results[mode])))
+
+    regressed = False
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        if baseline.get("settings") != settings:
+            print("baseline was recorded with other settings: %s"
+                  % baseline.get("settings"))
+        lines, regressed = compare(results, baseline, args.tolerance)
+        print("\n".join(lines))
+    if args.save_baseline:
+        with open(args.baseline, "w") as file:
+            json.dump({"settings": settings, "results": results}, file,
+                      indent=1)
+            file.write("\n")
+    return 1 if regressed and not args.save_baseline else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
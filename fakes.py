@@ -0,0 +1,427 @@
+import copy
+import datetime
+import json
+import operator
+import random
+import re
+import threading
+import time
+from collections import namedtuple
+
+import heuristics
+import reader
+
+# Firestore ops supported by FakeQuery, by FieldFilter op_string
+_OPERATORS = {
+    "==": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+    "in": lambda value, options: value in options,
+    "not-in": lambda value, options: value not in options,
+    "array-contains": lambda value, item: item in value,
+}
+_REVIEW_ID = re.compile(r"^\s*ID: (\d+)\s*$", re.MULTILINE)
+
+FakeResponse = namedtuple("FakeResponse", ["text"])
+
+
+class FakeModelError(Exception):
+    """Base class of the errors FakeChat raises"""
+
+
+class FakeRateLimitError(FakeModelError):
+    pass
+
+
+class Faults:
+    """Deterministic latency and error injection for the fakes.
+    Args:
+      latency: Seconds every call takes.
+      error_rate: Probability that a call fails.
+      seed: Seed for the failures, so runs are repeatable.
+    """
+
+    def __init__(self, latency=0.0, error_rate=0.0, seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def failed(self):
+        if not self.error_rate:
+            return False
+        with self._lock:
+            return self._rng.random() < self.error_rate
+
+    def cut(self, pieces):
+        """Where a stream of `pieces` fails, if it does: the index of the
+        piece that raises instead, or `pieces` for a failure at the end"""
+        if not self.failed():
+            return None
+        with self._lock:
+            return self._rng.randrange(pieces + 1)
+
+    def wait(self, seconds=0.0):
+        if self.latency + seconds > 0:
+            time.sleep(self.latency + seconds)
+
+
+class FakeChat:
+    """Offline stand-in for both chat backends in backends.py.
+
+    Completions echo each input question back with the correct answer
+    first, made-up wrong answers and an explanation, and are cut off at
+    max_tokens like the real API, or streamed in small pieces, where a
+    failure cuts the stream partway. Reviews rate every question with a
+    fixed, valid rating.
+    Args:
+      latency: Seconds per call.
+      token_latency: Extra seconds per completion token.
+      error_rate: Probability that a call raises FakeRateLimitError.
+      seed: Seed for the failures.
+    """
+
+    errors = FakeModelError
+    retryable_errors = (FakeRateLimitError,)
+    # characters per streamed piece, a few tokens like the real API
+    STREAM_PIECE = 16
+
+    def __init__(self, latency=0.0, token_latency=0.0, error_rate=0.0,
+                 seed=0):
+        self.faults = Faults(latency, error_rate, seed)
+        self.token_latency = token_latency
+
+    def _call(self, completion_tokens=0):
+        self.faults.wait(self.token_latency * completion_tokens)
+        if self.faults.failed():
+            raise FakeRateLimitError("fake rate limit")
+
+    def _respond(self, messages, max_tokens):
+        prompt = messages[-1]["content"]
+        questions = []
+        for line in prompt.rsplit("INPUT:", 1)[-1].splitlines():
+            question_obj = reader.parse_json_line(line)
+            if question_obj is not None:
+                questions.append(fix_question(question_obj))
+        text = "\n".join(json.dumps(question_obj, ensure_ascii=False) + ","
+                         for question_obj in questions)
+        prompt_tokens = sum(len(message["content"]) // 4 + 1
+                            for message in messages)
+        completion_tokens = len(text) // 4 + 1
+        finish_reason = "stop"
+        if max_tokens and completion_tokens > max_tokens:
+            text = text[:max_tokens * 4]
+            completion_tokens = max_tokens
+            finish_reason = "length"
+        return text, prompt_tokens, completion_tokens, finish_reason
+
+    def complete(self, model, messages, temperature=None, max_tokens=None,
+                 **request):
+        text, prompt_tokens, completion_tokens, finish_reason = (
+            self._respond(messages, max_tokens))
+        self._call(completion_tokens)
+        return {
+            "choices": [{"message": {"role": "assistant", "content": text},
+                         "finish_reason": finish_reason}],
+            "usage": {"prompt_tokens": prompt_tokens,
+                      "completion_tokens": completion_tokens,
+                      "total_tokens": prompt_tokens + completion_tokens},
+        }
+
+    def stream(self, model, messages, temperature=None, max_tokens=None,
+               **request):
+        text, _, _, finish_reason = self._respond(messages, max_tokens)
+        # the first piece waits out the call latency, later ones their
+        # tokens; a failure cuts the stream at a random piece
+        pieces = [text[start:start + self.STREAM_PIECE]
+                  for start in range(0, len(text), self.STREAM_PIECE)]
+        cut = self.faults.cut(len(pieces))
+        self.faults.wait()
+        for number, piece in enumerate(pieces):
+            if number == cut:
+                raise FakeRateLimitError("fake stream cut")
+            if self.token_latency:
+                time.sleep(self.token_latency * (len(piece) // 4 + 1))
+            yield piece, None
+        if cut == len(pieces):
+            raise FakeRateLimitError("fake stream cut")
+        yield "", finish_reason
+
+    def start_chat(self, model, context=None, examples=None, **kwargs):
+        return FakeChatSession(self)
+
+
+class FakeChatSession:
+    def __init__(self, chat):
+        self._chat = chat
+        self.message_history = []
+
+    def send_message(self, prompt, **parameters):
+        rating = {"problems": [], "humor": "low", "difficulty": "medium"}
+        ids = _REVIEW_ID.findall(prompt)
+        if ids:
+            text = json.dumps({number: rating for number in ids})
+        else:
+            text = json.dumps(rating)
+        self._chat._call(len(text) // 4 + 1)
+        self.message_history.extend((prompt, text))
+        return FakeResponse(text)
+
+
+def fix_question(question_obj):
+    """What the fake model returns for one input question"""
+    question_obj = dict(question_obj)
+    question_obj.pop("source", None)
+    question_obj.pop("tags", None)
+    answers = question_obj.get("answers")
+    if not isinstance(answers, list) or not answers:
+        answers = ["Unknown"]
+    answer = question_obj.get("answer", 0)
+    if not isinstance(answer, int) or not 0 <= answer < len(answers):
+        answer = 0
+    answers = [answers[answer]] + answers[:answer] + answers[answer + 1:]
+    while len(answers) < heuristics.MIN_ANSWERS:
+        answers.append("Wrong answer %d" % len(answers))
+    question_obj["answers"] = answers
+    question_obj["answer"] = 0
+    if not question_obj.get("explanation"):
+        question_obj["explanation"] = "A fake explanation for: %s" % (
+            question_obj.get("question"),)
+    return question_obj
+
+
+class FakeFirestore:
+    """In-memory stand-in for the parts of a Firestore client fixer.py
+    uses: collections, documents, queries, get_all and write batches.
+
+    Every round trip waits `latency` seconds. A failed round trip costs
+    another wait, like the retry the real client does internally.
+    """
+
+    # replaced by the time of the write, like the real service does
+    SERVER_TIMESTAMP = "SERVER_TIMESTAMP"
+
+    def __init__(self, latency=0.0, error_rate=0.0, seed=0):
+        self.faults = Faults(latency, error_rate, seed)
+        self.round_trips = 0
+        self.retries = 0
+        self._collections = {}
+        self._lock = threading.Lock()
+        self._ids = random.Random(seed)
+
+    def _round_trip(self):
+        self.round_trips += 1
+        self.faults.wait()
+        if self.faults.failed():
+            self.retries += 1
+            self.faults.wait()
+
+    def _documents(self, collection):
+        return self._collections.setdefault(collection, {})
+
+    def _new_id(self):
+        with self._lock:
+            return "%020x" % self._ids.getrandbits(80)
+
+    def _stored(self, data):
+        """A copy of data to store, with server timestamps filled in"""
+        if isinstance(data, dict):
+            return {key: self._stored(value) for key, value in data.items()}
+        if data == self.SERVER_TIMESTAMP:
+            return datetime.datetime.now(datetime.timezone.utc)
+        return copy.deepcopy(data)
+
+    def preload(self, collection, documents):
+        """Stores {id: data} without any latency, for seeding benchmarks"""
+        with self._lock:
+            self._documents(collection).update(copy.deepcopy(documents))
+
+    def collection(self, name):
+        return FakeCollection(self, name)
+
+    def get_all(self, refs):
+        self._round_trip()
+        return [ref._snapshot() for ref in refs]
+
+    def batch(self):
+        return FakeWriteBatch(self)
+
+
+class FakeSnapshot:
+    def __init__(self, reference, data):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self):
+        return copy.deepcopy(self._data) if self.exists else None
+
+    def get(self, field):
+        return copy.deepcopy(self._data[field])
+
+
+class FakeDocumentRef:
+    def __init__(self, db, collection, document_id):
+        self._db = db
+        self._collection = collection
+        self.id = document_id
+        self.path = "%s/%s" % (collection, document_id)
+
+    def _snapshot(self, fields=None):
+        with self._db._lock:
+            data = self._db._documents(self._collection).get(self.id)
+            if data is not None and fields is not None:
+                data = {key: value for key, value in data.items()
+                        if key in fields}
+            return FakeSnapshot(self, copy.deepcopy(data))
+
+    def _set(self, data, merge=False):
+        with self._db._lock:
+            documents = self._db._documents(self._collection)
+            if merge and self.id in documents:
+                documents[self.id].update(self._db._stored(data))
+            else:
+                documents[self.id] = self._db._stored(data)
+
+    def _update(self, data):
+        with self._db._lock:
+            documents = self._db._documents(self._collection)
+            if self.id not in documents:
+                raise KeyError("No document to update: " + self.path)
+            documents[self.id].update(self._db._stored(data))
+
+    def _delete(self):
+        with self._db._lock:
+            self._db._documents(self._collection).pop(self.id, None)
+
+    def get(self):
+        self._db._round_trip()
+        return self._snapshot()
+
+    def set(self, data, merge=False):
+        self._db._round_trip()
+        self._set(data, merge)
+
+    def update(self, data):
+        self._db._round_trip()
+        self._update(data)
+
+    def delete(self):
+        self._db._round_trip()
+        self._delete()
+
+
+class FakeQuery:
+    def __init__(self, db, collection, filters=(), order=None, limit=None,
+                 cursor=None, fields=None):
+        self._db = db
+        self._collection = collection
+        self._filters = tuple(filters)
+        self._order = order
+        self._limit = limit
+        self._cursor = cursor
+        self._fields = fields
+
+    def _copy(self, **changes):
+        state = {"filters": self._filters, "order": self._order,
+                 "limit": self._limit, "cursor": self._cursor,
+                 "fields": self._fields}
+        state.update(changes)
+        return FakeQuery(self._db, self._collection, **state)
+
+    def where(self, field_path=None, op_string=None, value=None, filter=None):
+        if filter is not None:
+            field_path = filter.field_path
+            op_string = filter.op_string
+            value = filter.value
+        return self._copy(filters=self._filters + (
+            (field_path, _OPERATORS[op_string], value),))
+
+    def order_by(self, field_path, direction=None):
+        return self._copy(order=field_path)
+
+    def limit(self, count):
+        return self._copy(limit=count)
+
+    def start_after(self, snapshot):
+        return self._copy(cursor=snapshot)
+
+    def select(self, field_paths):
+        return self._copy(fields=set(field_paths))
+
+    def _sort_key(self, document_id, data):
+        if self._order in (None, "__name__"):
+            return (document_id,)
+        return (data.get(self._order), document_id)
+
+    def stream(self):
+        self._db._round_trip()
+        with self._db._lock:
+            matching = [
+                (document_id, data) for document_id, data
+                in self._db._documents(self._collection).items()
+                if all(field in data and test(data[field], value)
+                       for field, test, value in self._filters)]
+        matching.sort(key=lambda item: self._sort_key(*item))
+        if self._cursor is not None:
+            cursor_key = self._sort_key(self._cursor.id,
+                                        self._cursor.to_dict() or {})
+            matching = [item for item in matching
+                        if self._sort_key(*item) > cursor_key]
+        if self._limit is not None:
+            matching = matching[:self._limit]
+        for document_id, _ in matching:
+            yield FakeDocumentRef(
+                self._db, self._collection, document_id)._snapshot(
+                    self._fields)
+
+
+class FakeCollection(FakeQuery):
+    def __init__(self, db, name):
+        super().__init__(db, name)
+        self.id = name
+
+    def document(self, document_id=None):
+        return FakeDocumentRef(self._db, self._collection,
+                               document_id or self._db._new_id())
+
+    def add(self, data):
+        ref = self.document()
+        ref.set(data)
+        return time.time(), ref
+
+
+class FakeWriteBatch:
+    # the real service rejects larger batches
+    MAX_OPERATIONS = 500
+
+    def __init__(self, db):
+        self._db = db
+        self._operations = []
+
+    def _queue(self, operation):
+        if len(self._operations) >= self.MAX_OPERATIONS:
+            raise ValueError("A write batch holds at most %d operations"
+                             % self.MAX_OPERATIONS)
+        self._operations.append(operation)
+
+    def set(self, ref, data, merge=False):
+        data = copy.deepcopy(data)
+        self._queue(lambda: ref._set(data, merge))
+
+    def update(self, ref, data):
+        data = copy.deepcopy(data)
+        self._queue(lambda: ref._update(data))
+
+    def delete(self, ref):
+        self._queue(ref._delete)
+
+    def commit(self):
+        self._db._round_trip()
+        for operation in self._operations:
+            operation()
+        self._operations = []
@@ -1,4 +1,5 @@
 import json
+import multiprocessing
 import os
 import random
 import time
@@ -6,131 +7,154 @@ import logging
 import coloredlogs
 import hashlib
 import argparse
-import vertexai
-import openai
-from itertools import islice
-from vertexai.preview.language_models import ChatModel, InputOutputTextPair
-import firebase_admin
-from firebase_admin import credentials
-from firebase_admin import firestore
-from google.cloud.firestore_v1.base_query import FieldFilter
-
-# Firebase for caching
-# Use the application default credentials.
-cred = credentials.ApplicationDefault()
-if not firebase_admin._apps:
-    firebase_admin.initialize_app(cred)
-    database_handle = firestore.client()
+import cProfile
+import glob
+import heuristics
+import threading
+import queue
+from collections import Counter, deque
+from concurrent.futures import (Future, ProcessPoolExecutor,
+                                ThreadPoolExecutor, as_completed)
+from itertools import islice, takewhile
+from ratelimit import RateLimiter, backoff_delay, call_with_retries
+from store import FIRESTORE_MAX_BATCH, UPDATED_FIELD, QuestionWriter
+import backends
+import fakes
+import input_index
+import metrics
+from metrics import METRICS
+from journal import Journal, journal_path
+import journal
+from input_index import DEFAULT_INDEX_PATH, InputIndex, raw_line_key
+from llm_cache import DEFAULT_CACHE_PATH, ResponseCache
+from snapshot import DEFAULT_SNAPSHOT_DIR
+import neardup
+import pack
+import reader
+import shards
+import snapshot
+import validate
 
+# Firebase for caching, OpenAI for fixing and Vertex for reviewing
+# questions. Each one is only imported and connected the first time a
+# mode needs it, so local modes and --nodb runs work without the SDKs
+# or credentials. use_backends() swaps in others, like the offline fakes.
+_LIVE_BACKENDS = {
+    "db": backends.firestore_client,
+    "chat": backends.OpenAIChat,
+    "reviews": backends.VertexChat,
+}
+_backends = {}
+_backends_lock = threading.Lock()
 
-VERTEX_STORY_MODEL = "chat-bison@001"
-# OPENAI_MODEL="gpt-4-0613"
-OPENAI_CHEAP_MODEL="gpt-3.5-turbo-0613"
-OPENAI_TEMPERATURE = 0.2
 
-logger = logging.getLogger(__name__)
-coloredlogs.install(level='DEBUG')
+def backend(name):
+    """Returns the "db", "chat" or "reviews" backend, creating the live
+    one on first use"""
+    with _backends_lock:
+        if name not in _backends:
+            logger.debug('Initializing the %s backend', name)
+            _backends[name] = _LIVE_BACKENDS[name]()
+        return _backends[name]
 
-def read_lines(filename):
-    """Reads the contents of a file and returns a list of lines.
-    Args:
-      filename: The name of the file to read.
-    Returns:
-      A list of lines in the file.
-    """
 
-    with open(filename, "r") as f:
-        lines = f.readlines()
-    return lines
+def use_backends(db=None, chat=None, reviews=None):
+    """Replaces the document store, completion and review backends"""
+    with _backends_lock:
+        for name, replacement in (("db", db), ("chat", chat),
+                                  ("reviews", reviews)):
+            if replacement is not None:
+                _backends[name] = replacement
 
 
-def parse_json_line(line):
-    """Parses a line of text into JSON and returns the result.
-    Args:
-      line: The line of text to parse.
-    Returns:
-      A JSON object or None if the line could not be parsed.
+# Names of the files a --backend fake run writes start with this
+FAKE_PREFIX = "fake."
+
+
+def install_backends(args):
+    """Switches to the offline fakes for --backend fake.
+
+    A fake run neither reads nor fills the response cache and the input
+    index, and state_path keeps its other files apart, so a later live
+    run doesn't replay fake answers or skip lines the fakes handled.
     """
+    if args.backend == "fake":
+        chat = fakes.FakeChat()
+        use_backends(fakes.FakeFirestore(), chat, chat)
+        args.no_cache = True
+        args.no_index = True
 
-    # chomp last comma
-    line = line[:-2]
-    try:
-        json_object = json.loads(line)
-        return json_object
-    except json.JSONDecodeError:
-        return None
 
+def state_path(args, path):
+    """Where a run keeps a journal, output, checkpoint or snapshot: the
+    same name with a "fake." prefix for --backend fake"""
+    if args.backend != "fake":
+        return path
+    head, tail = os.path.split(path.rstrip(os.sep))
+    return os.path.join(head, FAKE_PREFIX + tail)
+
+
+VERTEX_STORY_MODEL = "chat-bison@001"
+# OPENAI_MODEL="gpt-4-0613"
+OPENAI_CHEAP_MODEL="gpt-3.5-turbo-0613"
+OPENAI_TEMPERATURE = 0.2
+
+logger = logging.getLogger(__name__)
+coloredlogs.install(level='DEBUG')
 
 def banter(filename, type):
     """Parse an array of trivia objects and store in db"""
     file = open(filename)
     trash_array = json.load(file)
     for banter in trash_array:
-        logger.info("writing trash to db: %s", banter)
+        logger.debug("writing trash to db: %s", banter)
         banter["random_1"] = int(random.getrandbits(32))
         banter["random_2"] = int(random.getrandbits(32))
         banter["random_3"] = int(random.getrandbits(32))
         banter["type"] = type
-        database_handle.collection("banter").add(banter)
+        with METRICS.timer("firestore_write_seconds"):
+            backend("db").collection("banter").add(banter)
+        METRICS.count("firestore_writes")
     file.close()
 
 
-def check_and_fix_question(question_dict):
-    """Validates a question against heuristics and LLMs"""
+REVIEW_CONTEXT = "You are an editor and producer for a trivia gameshow. Please rate and respond to the following trivia questions."
 
-    if question_dict["correct_answer"].lower() in question_dict["question"].lower():
-        logging.warning(
-            'Found answer in question: "%s" (%s) (%s)',
-            question_dict["question"],
-            question_dict["correct_answer"],
-            question_dict["content_id"])
-        question_dict["question"] = (question_dict["question"]
-                                        .lower()
-                                        .replace(
-            question_dict["correct_answer"].lower(),
-                                                "_____")).capitalize()
-        logging.info('New question: "%s"', question_dict["question"])
-        (database_handle
-            .collection("trivia")
-            .document(question_dict["content_id"])
-            .update({
-                'question': question_dict["question"],
-                'to_review': True}))
-    else:
-        # Set up Vertex/PaLM
-        chat_model = ChatModel.from_pretrained(VERTEX_STORY_MODEL)
-        parameters = {
-            "temperature": 0.2,
-            "max_output_tokens": 1024,
-        }
-        chat = chat_model.start_chat(
-            context="You are an editor and producer for a trivia gameshow. Please rate and respond to the following trivia questions.",
-            examples=[
-                InputOutputTextPair(
-                    input_text="""The phrase \"Homo sapiens\" means ____. ANSWERS: [Man who thinks, Man of steel, Man of wisdom, Man of Saturn]. CORRECT ANSWER: Man who thinks.""",
-                    output_text="""{"problems": [], "humor": "low", "difficulty": "low"}""",
-                ),
-                InputOutputTextPair(
-                    input_text="""__________ and short_tailed shrews get by on only two hours of sleep a day. ANSWERS: [Elephants, Mice, Gerbils, Giraffes]. CORRECT ANSWER: Elephants""",
-                    output_text="""{"problems": [], "humor": "low", "difficulty": "medium"}""",
-                ),
-                InputOutputTextPair(
-                    input_text="""__________ and short_tailed shrews get by on only two hours of sleep a day. ANSWERS: [Elephants, Large Elephants, Gerbils, Giraffes]. CORRECT ANSWER: Elephants""",
-                    output_text="""{"problems": ["Elephants and 'Large Elephants' are too similar, and both could be considered correct"], "humor": "low", "difficulty": "medium"}""",
-                ),
-                InputOutputTextPair(
-                    input_text="""Elephants and short_tailed shrews get by on only two hours of sleep a day. ANSWERS: [Elephants, Mice, Gerbils, Giraffes]. CORRECT ANSWER: Elephants""",
-                    output_text="""{"problems": ["input is not a question"]}""",
-                ),
-                InputOutputTextPair(
-                    input_text="""Alligators and frogs can hear notes only up to ____ vibrations a second. ANSWERS: [4000, 5000, 3000, 2000]. CORRECT ANSWER: 4000""",
-                    output_text="""{"problems": ["Answers are too precise. Better answers would be further apart, like 4000, 20000, 100, 40000."], humor": "low", "difficulty": "high"}""",
-                ),
-            ],
-        )
-        try:
-            response = chat.send_message(
-                f"""Review the following question and return a JSON object
+# Turned into Vertex InputOutputTextPairs by backends.VertexChat
+REVIEW_EXAMPLES = [
+    dict(
+        input_text="""The phrase \"Homo sapiens\" means ____. ANSWERS: [Man who thinks, Man of steel, Man of wisdom, Man of Saturn]. CORRECT ANSWER: Man who thinks.""",
+        output_text="""{"problems": [], "humor": "low", "difficulty": "low"}""",
+    ),
+    dict(
+        input_text="""__________ and short_tailed shrews get by on only two hours of sleep a day. ANSWERS: [Elephants, Mice, Gerbils, Giraffes]. CORRECT ANSWER: Elephants""",
+        output_text="""{"problems": [], "humor": "low", "difficulty": "medium"}""",
+    ),
+    dict(
+        input_text="""__________ and short_tailed shrews get by on only two hours of sleep a day. ANSWERS: [Elephants, Large Elephants, Gerbils, Giraffes]. CORRECT ANSWER: Elephants""",
+        output_text="""{"problems": ["Elephants and 'Large Elephants' are too similar, and both could be considered correct"], "humor": "low", "difficulty": "medium"}""",
+    ),
+    dict(
+        input_text="""Elephants and short_tailed shrews get by on only two hours of sleep a day. ANSWERS: [Elephants, Mice, Gerbils, Giraffes]. CORRECT ANSWER: Elephants""",
+        output_text="""{"problems": ["input is not a question"]}""",
+    ),
+    dict(
+        input_text="""Alligators and frogs can hear notes only up to ____ vibrations a second. ANSWERS: [4000, 5000, 3000, 2000]. CORRECT ANSWER: 4000""",
+        output_text="""{"problems": ["Answers are too precise. Better answers would be further apart, like 4000, 20000, 100, 40000."], humor": "low", "difficulty": "high"}""",
+    ),
+]
+
+REVIEW_PARAMETERS = {
+    "temperature": 0.2,
+    "max_output_tokens": 1024,
+}
+
+REVIEW_BATCH_SIZE = 10
+
+
+def review_prompt(question_dict):
+    """Builds the prompt that reviews a single question"""
+    return f"""Review the following question and return a JSON object
                 listing any problems, then
                 score it for humor (low/medium/high) and
                 difficulty (low/medium/high).
@@ -147,102 +171,1025 @@ def check_and_fix_question(question_dict):
                 ANSWERS: {question_dict["answers"]}
                 CORRECT ANSWER: {question_dict["correct_answer"]}
                 ---
-                """,
-                **parameters)
-        except:
-            logger.warning('Error from VertexAI (sleeping): %s')
+                """
+
+
+def batch_review_prompt(questions):
+    """Builds a prompt that reviews several questions, keyed 1..n"""
+    inputs = "".join(
+        f"""ID: {number}
+                QUESTION: {question_dict["question"]}
+                ANSWERS: {question_dict["answers"]}
+                CORRECT ANSWER: {question_dict["correct_answer"]}
+                ---
+                """
+        for number, question_dict in enumerate(questions, start=1))
+    return f"""Review each of the following questions. Return ONE JSON
+                object that maps each question ID to an object listing any
+                problems, then scoring it for humor (low/medium/high) and
+                difficulty (low/medium/high), like
+                {{"1": {{"problems": [], "humor": "low", "difficulty": "low"}}}}.
+                A question has a PROBLEM
+                if the correct answer is not correct, if the answers are too
+                similar, or if the answers are overly quantitative.
+                DIFFICULTY is based on how many people would know the answer
+                (high = more than 50%, medium = 25%, low = below 25%) based
+                on how often the topic is discussed online.
+
+                INPUT
+                ---
+                {inputs}"""
+
+
+def parse_review(response_text):
+    """Parses the JSON object in a review response, or returns None"""
+    # the model sometimes wraps its answer in a ```json block
+    start = response_text.find("{")
+    end = response_text.rfind("}")
+    if start == -1 or end < start:
+        return None
+    try:
+        return json.loads(response_text[start:end + 1])
+    except json.JSONDecodeError:
+        return None
+
+
+class Reviewer:
+    """Reviews questions with one Vertex chat session per run"""
+
+    def __init__(self, cache=None):
+        self.cache = cache
+        self._chat = None
+
+    def _chat_session(self):
+        if self._chat is None:
+            # Set up Vertex/PaLM
+            self._chat = backend("reviews").start_chat(
+                VERTEX_STORY_MODEL,
+                context=REVIEW_CONTEXT,
+                examples=REVIEW_EXAMPLES,
+            )
+        return self._chat
+
+    def send(self, prompt):
+        """Returns the (possibly cached) response text, or None on error"""
+        if self.cache is not None:
+            response_text = self.cache.get(
+                VERTEX_STORY_MODEL, REVIEW_PARAMETERS["temperature"],
+                REVIEW_CONTEXT + prompt)
+            if response_text is not None:
+                return response_text
+        chat = self._chat_session()
+        METRICS.count("llm_calls")
+        try:
+            with METRICS.timer("llm_call_seconds"):
+                response = chat.send_message(prompt, **REVIEW_PARAMETERS)
+        except Exception as err:
+            METRICS.count("llm_errors")
+            logger.warning('Error from VertexAI (sleeping): %s', err)
             time.sleep(5)
-        if "false" in response.text:
+            return None
+        finally:
+            # every review is independent; don't resend earlier ones
+            del chat.message_history[:]
+        if self.cache is not None:
+            self.cache.put(VERTEX_STORY_MODEL,
+                           REVIEW_PARAMETERS["temperature"],
+                           REVIEW_CONTEXT + prompt, response.text)
+        return response.text
+
+    def review(self, question_dict):
+        """Reviews one question and returns the parsed rating, or None"""
+        response_text = self.send(review_prompt(question_dict))
+        if response_text is None:
+            return None
+        if "false" in response_text:
             logger.warning('Found problem with question %s', question_dict['content_id'])
-        logger.debug(f"Response from Model for '{question_dict['question']}':\n\t({question_dict['content_id']}): {response.text}")
+        logger.debug(f"Response from Model for '{question_dict['question']}':\n\t({question_dict['content_id']}): {response_text}")
         try:
-            output_obj = json.loads(response.text)
+            return json.loads(response_text)
         except json.JSONDecodeError as err:
-            logger.error('Could not parse JSON: %s (%s)', response.text, err)
-            return
-        output_obj['timestamp'] = firestore.SERVER_TIMESTAMP
-        output_obj['question'] = question_dict['question']
-        if len(output_obj['problems']) > 0:
-            (database_handle
+            METRICS.count("json_parse_failures")
+            logger.error('Could not parse JSON: %s (%s)', response_text, err)
+            return None
+
+    def review_batch(self, questions):
+        """Reviews several questions with a single request.
+
+        Questions whose rating is missing or malformed in the batch
+        response are reviewed again one at a time.
+        Returns:
+          A dict mapping content_id to the parsed rating.
+        """
+
+        if len(questions) == 1:
+            output_obj = self.review(questions[0])
+            if output_obj is None:
+                return {}
+            return {questions[0]["content_id"]: output_obj}
+
+        ratings = {}
+        response_text = self.send(batch_review_prompt(questions))
+        if response_text is not None:
+            logger.debug('Batch review response: %s', response_text)
+            ratings = parse_review(response_text)
+            if not isinstance(ratings, dict):
+                METRICS.count("json_parse_failures")
+                logger.error('Could not parse batch review: %s', response_text)
+                ratings = {}
+
+        results = {}
+        for number, question_dict in enumerate(questions, start=1):
+            output_obj = ratings.get(str(number))
+            if (not isinstance(output_obj, dict)
+                    or not isinstance(output_obj.get("problems"), list)):
+                logger.info('No batch rating for %s, reviewing it alone',
+                            question_dict["content_id"])
+                output_obj = self.review(question_dict)
+            if output_obj is not None:
+                results[question_dict["content_id"]] = output_obj
+        return results
+
+
+def fix_answer_in_question(question_dict):
+    """Blanks out the correct answer if the question gives it away.
+    Returns:
+      True if the question was changed and flagged for review.
+    """
+
+    if not heuristics.answer_in_question(question_dict["question"],
+                                         question_dict["correct_answer"]):
+        return False
+    logging.warning(
+        'Found answer in question: "%s" (%s) (%s)',
+        question_dict["question"],
+        question_dict["correct_answer"],
+        question_dict["content_id"])
+    question_dict["question"] = heuristics.blank_answer(
+        question_dict["question"], question_dict["correct_answer"])
+    logging.debug('New question: "%s"', question_dict["question"])
+    with METRICS.timer("firestore_write_seconds"):
+        (backend("db")
+            .collection("trivia")
+            .document(question_dict["content_id"])
+            .update({
+                'question': question_dict["question"],
+                'to_review': True,
+                UPDATED_FIELD: backends.server_timestamp(backend("db"))}))
+    METRICS.count("firestore_writes")
+    return True
+
+
+def save_review(question_dict, output_obj):
+    """Stores a model rating and marks the question as reviewed"""
+
+    output_obj['timestamp'] = backends.server_timestamp(backend("db"))
+    output_obj['question'] = question_dict['question']
+    with METRICS.timer("firestore_write_seconds"):
+        if len(output_obj.get('problems', [])) > 0:
+            (backend("db")
             .collection("trivia_feedback")
             .document("fixer.py-problems")
             .set({
                 question_dict['content_id']: output_obj,
             }, merge=True))
         else:
-            (database_handle
+            (backend("db")
             .collection("trivia_feedback")
             .document("fixer.py-good")
             .set({
                 question_dict['content_id']: output_obj,
             }, merge=True))
-        (database_handle
+        (backend("db")
             .collection("trivia")
             .document(question_dict["content_id"])
             .update({
                 'question': question_dict["question"],
-                'robo_reviewed': True}))
+                'robo_reviewed': True,
+                UPDATED_FIELD: output_obj['timestamp']}))
+    METRICS.count("firestore_writes", 2)
+
+
+def check_and_fix_question(question_dict, reviewer):
+    """Validates a question against heuristics and LLMs"""
+
+    if fix_answer_in_question(question_dict):
+        return
+    output_obj = reviewer.review(question_dict)
+    if output_obj is not None:
+        save_review(question_dict, output_obj)
+
+
+def review_questions(questions, reviewer):
+    """Reviews a batch of questions and saves the ratings"""
+    ratings = reviewer.review_batch(questions)
+    for question_dict in questions:
+        if question_dict["content_id"] in ratings:
+            save_review(question_dict, ratings[question_dict["content_id"]])
+
+
+CHECK_PAGE_SIZE = 100
+CHECK_CHECKPOINT_FILE = "trivia_check.checkpoint.json"
+
+
+def load_checkpoint(checkpoint_file):
+    """Returns the saved {category: last document id} map"""
+    try:
+        with open(checkpoint_file) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+
+
+def save_checkpoint(checkpoint_file, key, last_id):
+    """Records the last processed document id for `key`, or clears it"""
+    checkpoint = load_checkpoint(checkpoint_file)
+    if last_id is None:
+        checkpoint.pop(key, None)
+    else:
+        checkpoint[key] = last_id
+    # write and rename so a crash never leaves a half-written file
+    with open(checkpoint_file + ".tmp", "w") as file:
+        json.dump(checkpoint, file)
+    os.replace(checkpoint_file + ".tmp", checkpoint_file)
 
 
-def trivia_check(category):
-    """Check each entry in the database for correctness"""
-    questions = (database_handle
-                 .collection("trivia"))
+def firestore_question_pages(category, page_size, last_id=None):
+    """Yields pages of unchecked (document id, question dict) pairs from
+    Firestore, in document id order after `last_id`"""
+    collection = backend("db").collection("trivia")
+    # only unhandled questions, paged by document id so a run can resume
+    query = (collection
+             .where(filter=backends.field_filter("proofed", "==", False))
+             .where(filter=backends.field_filter("robo_reviewed", "==", False)))
     if category != "":
-        questions = questions.where(
-            filter=FieldFilter("category_id", "==", category))
+        query = query.where(
+            filter=backends.field_filter("category_id", "==", category))
+    query = query.order_by("__name__").limit(page_size)
 
-    questions = questions.stream()
+    cursor = None
+    if last_id:
+        cursor = collection.document(last_id).get()
+        if cursor.exists:
+            logger.info('Resuming after question %s', last_id)
+        else:
+            logger.warning('Checkpoint %s no longer exists, starting over',
+                           last_id)
+            cursor = None
 
-                 # .where(
-                 #       filter=FieldFilter("proofed", "!=", True))
-                 # .limit(50)
+    while True:
+        page = query if cursor is None else query.start_after(cursor)
+        with METRICS.timer("firestore_read_seconds"):
+            snapshots = list(page.stream())
+        METRICS.count("firestore_reads", len(snapshots))
+        if not snapshots:
+            return
+        yield [(question.id, question.to_dict()) for question in snapshots]
+        if len(snapshots) < page_size:
+            return
+        cursor = snapshots[-1]
 
-    for question in questions:
-        question_dict = question.to_dict()
-        logging.debug('Checking question %s', question_dict["content_id"])
-        if question_dict.get("proofed"):
-            logging.debug('Question already proofed, skipping')
-            continue
-        check_and_fix_question(question_dict)
 
+def local_question_pages(snapshot_dir, category, page_size, last_id=None):
+    """Same as firestore_question_pages, from the local snapshot"""
+    where = {"proofed": False, "robo_reviewed": False}
     if category != "":
-        logger.info('category set; skipping user feedback')
-        return
+        where["category_id"] = category
+    questions = snapshot.find(snapshot_dir, "trivia", where,
+                              shard=category or None)
+    if last_id:
+        logger.info('Resuming after question %s', last_id)
+        questions = [item for item in questions if item[0] > last_id]
+    for start in range(0, len(questions), page_size):
+        yield questions[start:start + page_size]
 
-    logger.info('Moving to user feedback')
-    users = (database_handle
-                 .collection("trivia_feedback")
-                 .stream())
-    for user in users:
-        feedback_report = user.to_dict()
+
+def report_feedback(source="firestore", snapshot_dir=DEFAULT_SNAPSHOT_DIR):
+    """Logs the user feedback, with each question reported as a problem"""
+    if source == "local":
+        reports = list(snapshot.iter_documents(snapshot_dir,
+                                               "trivia_feedback"))
+    else:
+        reports = [(user.id, user.to_dict())
+                   for user in (backend("db")
+                                .collection("trivia_feedback")
+                                .stream())]
+    problem_ids = sorted({
+        feedback for _, feedback_report in reports
+        for feedback in feedback_report
+        if feedback_report[feedback].get("type") == 'problem'})
+    if source == "local":
+        questions = snapshot.get_documents(snapshot_dir, "trivia", problem_ids)
+    else:
+        # one round trip for all reported questions
+        collection = backend("db").collection("trivia")
+        questions = {
+            question.id: question.to_dict()
+            for question in backend("db").get_all(
+                [collection.document(content_id)
+                 for content_id in problem_ids])
+            if question.exists} if problem_ids else {}
+
+    for user_id, feedback_report in reports:
         for feedback in feedback_report:
             if feedback_report[feedback].get("type") == 'problem':
                 logging.warning("""Problematic question
                                 with content_id %s reported by
                                 user %s""",
                                 feedback,
-                                user.id)
-                question = (database_handle
-                            .collection("trivia")
-                            .document(feedback)
-                            .get())
-                if question.exists:
-                    logging.warning(question.to_dict())
+                                user_id)
+                if feedback in questions:
+                    logging.warning(questions[feedback])
             else:
                 logging.info("Feedback for content %s: %s",
                              feedback,
                              feedback_report[feedback].get("type"),)
 
-def main():
-    '''Process input files from Open-trivia-database and ask LLM to
-    fix formatting problems and add multiple-choice answers'''
 
-    logging.basicConfig(level=logging.DEBUG)
+def trivia_check(category, cache=None, batch_size=REVIEW_BATCH_SIZE,
+                 page_size=CHECK_PAGE_SIZE, resume=False,
+                 checkpoint_file=CHECK_CHECKPOINT_FILE, source="firestore",
+                 snapshot_dir=DEFAULT_SNAPSHOT_DIR):
+    """Check each entry in the database for correctness.
+
+    With source "local" the questions and the user feedback are read
+    from the snapshot that <sync> keeps in snapshot_dir; fixes and
+    reviews are still written to Firestore, one document at a time.
+    """
+    reviewer = Reviewer(cache)
+    checkpoint_key = category or "*"
+    last_id = None
+    if resume:
+        last_id = load_checkpoint(checkpoint_file).get(checkpoint_key)
+    if source == "local":
+        pages = local_question_pages(snapshot_dir, category, page_size,
+                                     last_id)
+    else:
+        pages = firestore_question_pages(category, page_size, last_id)
+
+    for page in pages:
+        pending = []
+        for _, question_dict in page:
+            logging.debug('Checking question %s', question_dict["content_id"])
+            METRICS.count("questions_checked")
+            if fix_answer_in_question(question_dict):
+                continue
+            pending.append(question_dict)
+            if len(pending) >= batch_size:
+                review_questions(pending, reviewer)
+                pending = []
+        if pending:
+            review_questions(pending, reviewer)
+        save_checkpoint(checkpoint_file, checkpoint_key, page[-1][0])
+    save_checkpoint(checkpoint_file, checkpoint_key, None)
+
+    if category != "":
+        logger.info('category set; skipping user feedback')
+        return
+
+    logger.info('Moving to user feedback')
+    report_feedback(source, snapshot_dir)
+
+
+TRIVIA_SYSTEM_PROMPT = "You are a code editor for a set of trivia questions stored as JSON objects. Please fix the following trivia questions."
+
+TRIVIA_PROMPT_TEMPLATE = """For each line in the following JSON array, please perform
+        the following steps:
+        1) Inside the "question" element, escape all
+        unescaped or duplicated quotation marks with a \ character so the line is valid JSON
+        2) Fix unnecessary title casing
+        3) Remove unncessary spaces near quotation marks
+        4) Add three plausible, unique, wrong entries to the `answers` array
+        5) Ensure the "answer" does not appear in the "question"; if there is a "____" in the input, DO NOT REPLACE IT
+        6) Please provide an explanation and interesting factoid in the "explanation" parameter
+        7) Remove the "source" and "tags" parameters
+        8) Please format the output with each object on ONE SINGLE line
+
+        EXAMPLES:
+            input_text={"category_id":"SCIENCE_AND_NATURE", "lang":"en", "tags":[], "question":"The phrase "Homo sapiens " means ____", "answer":0, "answers":["Man of knowledge"], "source":""},
+            output_text={"category_id":"SCIENCE_AND_NATURE", "lang":"en", "question":"The phrase \"Homo sapiens\" means ____", "answer":0, "answers":["Man of knowledge", "Man of science", "Man who thinks", "Man of steel"], "explanation":"The phrase \"Homo sapiens\" was first coined by Carl Linnaeus in 1758, a Swedish biologist who created the Latin binomial nomenclature"},
+
+            input_text={"category_id":"SCIENCE_AND_NATURE", "lang":"en", "tags":["SCIENCE_AND_NATURE"], "question":"__________ and short_tailed shrews get by on only two hours of sleep a day.", "answer":0, "answers":["Elephants"], "source":""},
+            output_text={"category_id":"SCIENCE_AND_NATURE", "lang":"en", "question":"__________ and short tailed shrews get by on only two hours of sleep a day.", "answer":0, "answers":["Elephants", "Horses", "Hippos", "Voles"], "explanation":"Elephants are the shortest sleeping mammal, and only dream every three to four days"},
+
+        INPUT:
+        """
+
+# Used for lines that were already cleaned up by the local heuristics
+ANSWERS_PROMPT_TEMPLATE = """For each line in the following JSON array, please perform
+        the following steps:
+        1) Add three plausible, unique, wrong entries to the `answers` array
+        2) Keep the "question" text as it is; if there is a "____" in it, DO NOT REPLACE IT
+        3) Please provide an explanation and interesting factoid in the "explanation" parameter
+        4) Please format the output with each object on ONE SINGLE line
+
+        EXAMPLE:
+            input_text={"category_id":"SCIENCE_AND_NATURE", "lang":"en", "question":"__________ and short tailed shrews get by on only two hours of sleep a day.", "answer":0, "answers":["Elephants"]},
+            output_text={"category_id":"SCIENCE_AND_NATURE", "lang":"en", "question":"__________ and short tailed shrews get by on only two hours of sleep a day.", "answer":0, "answers":["Elephants", "Horses", "Hippos", "Voles"], "explanation":"Elephants are the shortest sleeping mammal, and only dream every three to four days"},
+
+        INPUT:
+        """
+
+# Function-calling schema for the trivia output; not passed to the model yet.
+TRIVIA_FUNCTIONS = [
+    {
+        "name": "ask_trivia_question",
+        "description": "Ask user trivia question, evaluate answer, and pring explanation",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "category_id": {
+                    "type": "string",
+                    "description": "The category of the question, e.g. SCIENCE_AND_NATURE"
+                },
+                "lang": {
+                    "type": "string",
+                    "description": "The language code for the question, e.g. en"
+                },
+                "question": {
+                    "type": "string",
+                    "description": "Sentence-cased text of the trivia question, with any quotes escaped with '/' "
+                },
+                "answer": {
+                    "type": "integer",
+                    "description": "The index of the correct answer from the 'answers' array"
+                },
+                "answers": {
+                    "type": "array",
+                    "items": {
+                        "type": "string"
+                    },
+                    "description": "An array containing possible answer choices"
+                },
+                "source": {
+                    "type": "string",
+                    "description": "The source from which the question was derived"
+                },
+                "explanation": {
+                    "type": "string",
+                    "description": "A brief explanation or factoid related to the question and answer"
+                }
+            }
+        }
+    }
+]
+
+OPENAI_MAX_TOKENS = 2500
+# Expected completion tokens per packed batch; the headroom under
+# OPENAI_MAX_TOKENS absorbs estimation error
+BATCH_OUTPUT_TOKENS = 2000
+# Upper bound on lines per batch, however short they are
+MAX_BATCH_LINES = 40
+# What the model adds to a line: each missing answer, and an explanation
+ADDED_ANSWER_TOKENS = 8
+ADDED_EXPLANATION_TOKENS = 60
+
+
+def estimate_tokens(text):
+    """Rough token count (~4 characters per token) used for rate limiting"""
+    return len(text) // 4 + 1
+
+
+def expected_output_tokens(line):
+    """Estimates the completion tokens the model spends on one input line:
+    the line itself plus the answers and explanation it has to add"""
+    tokens = estimate_tokens(line)
+    question_obj = reader.parse_json_line(line)
+    if question_obj is None:
+        return (tokens + (heuristics.MIN_ANSWERS - 1) * ADDED_ANSWER_TOKENS
+                + ADDED_EXPLANATION_TOKENS)
+    answers = question_obj.get("answers")
+    answer_count = len(answers) if isinstance(answers, list) else 0
+    tokens += (max(0, heuristics.MIN_ANSWERS - answer_count)
+               * ADDED_ANSWER_TOKENS)
+    if not question_obj.get("explanation"):
+        tokens += ADDED_EXPLANATION_TOKENS
+    return tokens
+
+
+def take_batch(buffer, token_budget, final=False):
+    """Removes the next batch from the front of a buffer of (line, key,
+    line number) items, packing lines up to `token_budget` expected
+    completion tokens.
+    Args:
+      buffer: Items waiting for a batch, in input order.
+      token_budget: Expected completion tokens per batch.
+      final: No more input is coming, so a partial batch is fine.
+    Returns:
+      (batch, expected tokens), or (None, 0) if the buffer doesn't fill a
+      batch yet. A line over budget on its own still gets a batch.
+    """
+
+    total = 0
+    size = 0
+    for line, _, _ in buffer:
+        tokens = expected_output_tokens(line)
+        if size and (total + tokens > token_budget
+                     or size == MAX_BATCH_LINES):
+            break
+        total += tokens
+        size += 1
+    else:
+        if not final or not buffer:
+            return None, 0
+    batch = buffer[:size]
+    del buffer[:size]
+    return batch, total
+
+
+class TruncatedResponse(Exception):
+    """The model stopped at max_tokens; `response` has the partial text"""
+
+    def __init__(self, response):
+        super().__init__("response truncated at max_tokens")
+        self.response = response
+
+
+def is_wrapper(line):
+    """True for lines the model puts around its answer: blank lines, the
+    array brackets and ``` fences"""
+    return reader.is_structural(line) or line.strip().startswith("```")
+
+
+def response_objects(response_message):
+    """Counts the JSON object lines of a response.
+
+    Like parse_review, whatever the model writes before the first object
+    or after the last, e.g. a ```json fence, is ignored.
+    Returns:
+      The number of objects, or None if a line between them isn't one.
+    """
+
+    parsed = [reader.parse_json_line(line)
+              for line in response_message.splitlines()
+              if not is_wrapper(line)]
+    found = [number for number, question_obj in enumerate(parsed)
+             if question_obj is not None]
+    if found and len(found) != found[-1] - found[0] + 1:
+        return None
+    return len(found)
+
+
+def batch_request(input_lines, template=TRIVIA_PROMPT_TEMPLATE):
+    """Returns the chat messages for one batch and the tokens it may use"""
+    messages = [
+        {
+            "role": "system",
+            "content": TRIVIA_SYSTEM_PROMPT,
+        },
+        {
+            "role": "user",
+            "content": template + input_lines,
+        }
+    ]
+    request_tokens = (estimate_tokens(TRIVIA_SYSTEM_PROMPT)
+                      + estimate_tokens(messages[1]["content"])
+                      + OPENAI_MAX_TOKENS)
+    return messages, request_tokens
+
+
+def complete_batch(input_lines, limiter, max_retries, cache=None,
+                   template=TRIVIA_PROMPT_TEMPLATE, expected_tokens=None):
+    """Sends one batch of raw question lines to the model.
+    Args:
+      input_lines: Concatenated JSON lines from the input file.
+      limiter: RateLimiter shared by all in-flight batches.
+      max_retries: How many times to retry transient OpenAI errors.
+      cache: Optional ResponseCache consulted before calling the model.
+      template: Prompt placed in front of the input lines.
+      expected_tokens: Estimated completion tokens, logged next to the
+        actual usage.
+    Returns:
+      The text of the model response.
+    Raises:
+      TruncatedResponse: The model ran out of tokens. Truncated
+        responses are not cached.
+    """
+
+    messages, request_tokens = batch_request(input_lines, template)
+
+    def create():
+        limiter.acquire(request_tokens)
+        METRICS.count("llm_calls")
+        with METRICS.timer("llm_call_seconds"):
+            return backend("chat").complete(
+                model=OPENAI_CHEAP_MODEL,
+                messages=messages,
+                temperature=OPENAI_TEMPERATURE,
+                max_tokens=OPENAI_MAX_TOKENS,
+            )
+
+    # vertex/PaLM call
+    # response = chat.send_message(
+    #     TRIVIA_PROMPT_TEMPLATE + input_lines,
+    #     **parameters)
+    # response_message = response.text
+
+    def complete():
+        response = call_with_retries(
+            create, backend("chat").retryable_errors,
+            max_retries=max_retries)
+        choice = response["choices"][0]
+        usage = response.get("usage", {})
+        METRICS.count("llm_prompt_tokens", usage.get("prompt_tokens", 0))
+        METRICS.count("llm_completion_tokens",
+                      usage.get("completion_tokens", 0))
+        logger.info('Batch of %s lines used %s prompt + %s completion '
+                    'tokens (expected %s completion)',
+                    input_lines.count("\n"), usage.get("prompt_tokens"),
+                    usage.get("completion_tokens"), expected_tokens)
+        if choice.get("finish_reason") == "length":
+            METRICS.count("llm_truncated")
+            raise TruncatedResponse(choice["message"]["content"])
+        return choice["message"]["content"]
+
+    if cache is None:
+        return complete()
+    return cache.get_or_call(
+        OPENAI_CHEAP_MODEL, OPENAI_TEMPERATURE,
+        json.dumps([messages, OPENAI_MAX_TOKENS]), complete)
+
+
+def complete_packed(batch, limiter, max_retries, cache=None,
+                    template=TRIVIA_PROMPT_TEMPLATE, expected_tokens=None):
+    """Completes a packed batch of (line, key, line number) items.
+
+    While the response is truncated, has lines that don't parse or has
+    fewer objects than the batch has lines, the batch is split in half
+    and each half is sent on its own; a single line that still gets no
+    object is given up on.
+    Returns:
+      The response text, in the order of the batch, and the items that
+      got no response object, for the problems file.
+    """
+
+    input_lines = "".join(line + "\n" for line, _, _ in batch)
+    try:
+        response_message = complete_batch(input_lines, limiter, max_retries,
+                                          cache, template, expected_tokens)
+        answered = response_objects(response_message)
+    except TruncatedResponse as err:
+        response_message = err.response
+        answered = None
+    if answered is not None and answered >= len(batch):
+        return response_message, []
+    if len(batch) == 1:
+        return response_message, [] if answered else list(batch)
+
+    logger.warning('Splitting a batch of %s lines after a truncated, short '
+                   'or unparseable response', len(batch))
+    METRICS.count("llm_batch_splits")
+    half = len(batch) // 2
+    responses, failed = zip(*(
+        complete_packed(part, limiter, max_retries, cache, template,
+                        sum(expected_output_tokens(line)
+                            for line, _, _ in part))
+        for part in (batch[:half], batch[half:])))
+    return "\n".join(responses), failed[0] + failed[1]
+
+
+def stream_batch(input_lines, limiter, cache=None,
+                 template=TRIVIA_PROMPT_TEMPLATE):
+    """Streams the model response to one batch of raw question lines.
+
+    A response that streams to the end is cached, and a cached response
+    is replayed without calling the model.
+    Args:
+      input_lines: Concatenated JSON lines from the input file.
+      limiter: RateLimiter shared by all in-flight batches.
+      cache: Optional ResponseCache, shared with complete_batch.
+      template: Prompt placed in front of the input lines.
+    Yields:
+      Each non-blank response line as soon as its newline arrives.
+    Raises:
+      TruncatedResponse: The model ran out of tokens. The partial last
+        line is not yielded.
+    """
+
+    messages, request_tokens = batch_request(input_lines, template)
+    prompt = json.dumps([messages, OPENAI_MAX_TOKENS])
+    if cache is not None:
+        cached = cache.get(OPENAI_CHEAP_MODEL, OPENAI_TEMPERATURE, prompt)
+        if cached is not None:
+            yield from (line for line in cached.splitlines() if line.strip())
+            return
+
+    limiter.acquire(request_tokens)
+    METRICS.count("llm_calls")
+    start = time.perf_counter()
+    received = []
+    partial = ""
+    finish_reason = None
+    with METRICS.timer("llm_call_seconds"):
+        for text, finish_reason in backend("chat").stream(
+                model=OPENAI_CHEAP_MODEL,
+                messages=messages,
+                temperature=OPENAI_TEMPERATURE,
+                max_tokens=OPENAI_MAX_TOKENS):
+            *complete, partial = (partial + text).split("\n")
+            for response_line in complete:
+                if not response_line.strip():
+                    continue
+                if not received:
+                    METRICS.observe("llm_first_line_seconds",
+                                    time.perf_counter() - start)
+                received.append(response_line)
+                yield response_line
+    METRICS.count("llm_completion_tokens",
+                  estimate_tokens("\n".join(received + [partial])))
+    if finish_reason == "length":
+        METRICS.count("llm_truncated")
+        raise TruncatedResponse("\n".join(received + [partial]))
+    if partial.strip():
+        received.append(partial)
+        yield partial
+    if cache is not None:
+        cache.put(OPENAI_CHEAP_MODEL, OPENAI_TEMPERATURE, prompt,
+                  "\n".join(received))
+
+
+def stream_packed(batch, limiter, max_retries, cache=None,
+                  template=TRIVIA_PROMPT_TEMPLATE, emit=None):
+    """Streams the completion of a packed batch of (line, key, line
+    number) items, handing every response line to `emit` as it arrives.
+
+    Response lines that hold a JSON object answer the batch in order;
+    anything else the model writes, like a ```json fence or a sentence
+    of chatter, is emitted but answers nothing. When the stream is cut by
+    an error or at max_tokens, the lines already emitted are kept and
+    only the rest of the batch is sent again.
+    Returns:
+      The items that got no response line, for the problems file.
+    """
+
+    remaining = list(batch)
+    failed = []
+    attempt = 0
+    while remaining:
+        input_lines = "".join(line + "\n" for line, _, _ in remaining)
+        answered = 0
+        try:
+            for response_line in stream_batch(input_lines, limiter, cache,
+                                              template):
+                emit(response_line)
+                if reader.parse_json_line(response_line) is not None:
+                    answered += 1
+            # lines the model left out of a finished response stay out
+            failed.extend(remaining[answered:])
+            break
+        except TruncatedResponse:
+            METRICS.count("llm_stream_resumes")
+            if not answered:
+                logger.warning('The response to one line does not fit in '
+                               '%s tokens', OPENAI_MAX_TOKENS)
+                failed.append(remaining[0])
+                answered = 1
+        except backend("chat").retryable_errors as err:
+            METRICS.count("llm_stream_cuts")
+            if answered:
+                attempt = 0
+            if attempt >= max_retries:
+                logger.error('Giving up on %s lines after %s retries: %s',
+                             len(remaining) - answered, max_retries, err)
+                failed.extend(remaining[answered:])
+                break
+            delay = backoff_delay(attempt)
+            attempt += 1
+            logger.warning('Stream cut after %s of %s lines, retry %s/%s of '
+                           'the rest in %.1fs: %s', answered, len(remaining),
+                           attempt, max_retries, delay, err)
+            time.sleep(delay)
+        except backend("chat").errors as err:
+            logger.error('Giving up on %s lines: %s',
+                         len(remaining) - answered, err)
+            failed.extend(remaining[answered:])
+            break
+        remaining = remaining[answered:]
+    return failed
+
+
+def drain_stream(line_queue):
+    """Yields the lines on a stream's queue in chunks of whatever has
+    arrived, blocking only while nothing has, up to the closing None"""
+    while True:
+        chunk = [line_queue.get()]
+        while chunk[-1] is not None:
+            try:
+                chunk.append(line_queue.get_nowait())
+            except queue.Empty:
+                break
+        if chunk[-1] is None:
+            if len(chunk) > 1:
+                yield chunk[:-1]
+            return
+        yield chunk
+
+
+def route_lines(items, buffers, rule_counts):
+    """Applies the local heuristic fixes and sorts lines by remaining work.
+
+    Lines with text problems left go to the full prompt's buffer, lines
+    that only need answers and an explanation go to the short prompt's.
+    Args:
+      items: (line, input key, line number) tuples read from the file.
+      buffers: Lists of pending items, keyed by prompt template.
+      rule_counts: Counter of the heuristic rules that fired.
+    Returns:
+      The items that need no model call at all, and the line numbers of
+      lines that hold no question.
+    """
+
+    local = []
+    dropped = []
+    for line, key, line_number in items:
+        result = heuristics.fix_line(line)
+        if result is None:
+            dropped.append(line_number)
+            continue
+        rule_counts.update(result.rules)
+        if result.question is None:
+            buffers[TRIVIA_PROMPT_TEMPLATE].append((line, key, line_number))
+            continue
+        logger.debug('Local fixes %s: %s', result.rules,
+                     result.question["question"])
+        question_obj = result.question
+        fixed_line = json.dumps(question_obj, ensure_ascii=False)
+        if result.needs_rewrite:
+            buffers[TRIVIA_PROMPT_TEMPLATE].append(
+                (fixed_line + ",", key, line_number))
+        elif result.needs_answers:
+            buffers[ANSWERS_PROMPT_TEMPLATE].append(
+                (fixed_line + ",", key, line_number))
+        else:
+            # ingest expects the correct answer first
+            answers = question_obj["answers"]
+            correct = answers.pop(question_obj.get("answer", 0))
+            question_obj["answers"] = [correct] + answers
+            question_obj["answer"] = 0
+            local.append((json.dumps(question_obj, ensure_ascii=False),
+                          key, line_number))
+    return local, dropped
+
+
+def ingest_response(response_message, writer, problem_file):
+    """Parses a model response line by line and queues questions for the db
+    Args:
+      response_message: Text returned by the model, one object per line.
+      writer: QuestionWriter to queue new questions on, or None for --nodb.
+      problem_file: File that collects lines that could not be used.
+    Returns:
+      The parsed question dicts.
+    """
+
+    questions = []
+    for response_line in response_message.splitlines():
+        trimmed_line = response_line
+        question_obj = set()
+        try:
+            if is_wrapper(trimmed_line):
+                # skip blank lines and the ```json fence around them
+                continue
+            # chomp the trailing , so we can parse this individually
+            if trimmed_line[-1] == ',':
+                trimmed_line = trimmed_line[:-1]
+            question_obj = json.loads(trimmed_line)
+        except json.JSONDecodeError as err:
+            METRICS.count("json_parse_failures")
+            logger.error(
+                "Could not parse line '%s', %s @ %s",
+                response_line,
+                err.msg,
+                err.pos)
+            problem_file.write(response_line + "\n")
+            continue
+
+        question_obj["random_1"] = int(random.getrandbits(32))
+        question_obj["random_2"] = int(random.getrandbits(32))
+        question_obj["random_3"] = int(random.getrandbits(32))
+        try:
+            question_obj["correct_answer"] = question_obj["answers"][0]
+        except KeyError as err:
+            logger.error("Missing answer in question %s (%s)",
+                         trimmed_line, err)
+            problem_file.write(response_line + "\n")
+
+        # The document id hashes the post-LLM question text; the raw
+        # input line is mapped to it by input_index.record_batch, so a
+        # rerun skips the line before it reaches the model
+        if "question" not in question_obj:
+            logger.error("Missing question text in %s", trimmed_line)
+            problem_file.write(response_line + "\n")
+            continue
+        question_key = hashlib.sha1(
+            question_obj["question"].encode("utf-8")).hexdigest()
+        question_obj["content_id"] = question_key
+        question_obj["proofed"] = False
+        question_obj["robo_reviewed"] = False
+
+        # remove "answer" key, which was a complicated array index
+        try:
+            question_obj.pop("answer")
+        except (KeyError):
+            # ignore
+            logger.debug('question had no "answer" field')
+        questions.append(question_obj)
+
+    # save to database
+    if writer is not None:
+        writer.add_all(questions)
+    return questions
+
+
+def backfill_reviewed(flush_size=FIRESTORE_MAX_BATCH):
+    """Sets robo_reviewed=False on unproofed questions that lack the field,
+    so the server-side filter in trivia_check can find them"""
+
+    flush_size = max(1, min(flush_size, FIRESTORE_MAX_BATCH))
+    questions = (backend("db")
+                 .collection("trivia")
+                 .where(filter=backends.field_filter("proofed", "==", False))
+                 .select(["robo_reviewed"])
+                 .stream())
+    batch = backend("db").batch()
+    queued = 0
+    updated = 0
+    for question in questions:
+        if "robo_reviewed" in question.to_dict():
+            continue
+        batch.update(question.reference, {
+            "robo_reviewed": False,
+            UPDATED_FIELD: backends.server_timestamp(backend("db"))})
+        queued += 1
+        if queued >= flush_size:
+            with METRICS.timer("firestore_write_seconds"):
+                batch.commit()
+            METRICS.count("firestore_writes", queued)
+            updated += queued
+            batch = backend("db").batch()
+            queued = 0
+    if queued:
+        with METRICS.timer("firestore_write_seconds"):
+            batch.commit()
+        METRICS.count("firestore_writes", queued)
+        updated += queued
+    logger.info('Backfilled robo_reviewed on %s questions', updated)
+
+
+def sync_snapshot(snapshot_dir=DEFAULT_SNAPSHOT_DIR, full=False):
+    """Updates the local snapshot that <trivia_check> --source local reads:
+    trivia incrementally, sharded by category, and all of the feedback"""
+    snapshot.sync(backend("db"), snapshot_dir, "trivia",
+                  shard_field="category_id", full=full)
+    # feedback documents have no update time to sync from
+    snapshot.sync(backend("db"), snapshot_dir, "trivia_feedback", full=True)
+
+
+def validate_files(args):
+    """Runs <validate>: prints each violation as path:line: rule: message
+    and exits with status 1 if there are any"""
+    reports = validate.validate(cache_path=args.validate_cache,
+                                processes=args.processes)
+    if args.promote:
+        moved = validate.promote(reports, args.promote)
+        logger.info('Moved %s passing records to %s', moved, args.promote)
+        if moved:
+            # the moved records are checked again in their new files
+            reports = validate.validate(cache_path=args.validate_cache,
+                                        processes=args.processes)
+    violations = 0
+    for line in validate.format_violations(reports):
+        print(line)
+        violations += 1
+    logger.info('Validated %s files: %s', len(reports),
+                dict(validate.summarize(reports)))
+    if violations:
+        raise SystemExit(1)
+
+
+def build_parser():
+    """Returns the command line parser for main()"""
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "--filename",
         help="The trivia question JSON list")
+    parser.add_argument(
+        "--glob",
+        help="""Glob of question files, or a directory of them, to run
+        <trivia> over in parallel; --limit applies to each shard""",
+        default="",
+    )
+    parser.add_argument(
+        "--processes",
+        help="Worker processes for --glob and <validate>",
+        default=4,
+        type=int,
+    )
+    parser.add_argument(
+        "--shard-lines",
+        help="Lines per shard when --glob splits big files",
+        default=shards.DEFAULT_SHARD_LINES,
+        type=int,
+    )
     parser.add_argument(
         "--nodb",
         help="Don't write to the database",
@@ -257,7 +1204,17 @@ def main():
     parser.add_argument(
         "--mode",
         help="""Should this read <trivia> (default) or <trash>
-        or <congrats> or <trivia_check>?""",
+        or <congrats> or <trivia_check>, or <rebuild_index> from
+        --filename .out files and --export dumps, or <backfill_reviewed>
+        to add robo_reviewed=False to questions written before it existed,
+        or <build_pack> to compile the en/ and fr/ files into --pack,
+        or <neardup> to write --clusters of near-duplicate questions
+        in the --filename glob, or <fix_local> to run the local
+        heuristic fixes over --filename, or <status> to report the
+        progress of the journals in the --filename glob, or <sync> to
+        bring the local --snapshot of the trivia collection up to date,
+        or <export> to write it from scratch, or <validate> to check the
+        en/ and fr/ files against the README rules?""",
         default="trivia"
     )
     parser.add_argument(
@@ -266,230 +1223,517 @@ def main():
         default="",
         type=str,
     )
+    parser.add_argument(
+        "--review-batch",
+        help="Questions per review request in <trivia_check>",
+        default=REVIEW_BATCH_SIZE,
+        type=int,
+    )
+    parser.add_argument(
+        "--page-size",
+        help="Questions fetched per query page in <trivia_check>",
+        default=CHECK_PAGE_SIZE,
+        type=int,
+    )
+    parser.add_argument(
+        "--source",
+        help="""Where <trivia_check> reads questions and user feedback:
+        Firestore, or the local --snapshot written by <sync>""",
+        choices=("firestore", "local"),
+        default="firestore",
+    )
+    parser.add_argument(
+        "--snapshot",
+        help="Directory of the local JSONL snapshot for <sync>/<export>",
+        default=DEFAULT_SNAPSHOT_DIR,
+    )
+    parser.add_argument(
+        "--promote",
+        help="""<validate>: move todo records that pass every rule to
+        need_review/, or to the language folder itself with 'root'""",
+        choices=validate.PROMOTE_TARGETS,
+    )
+    parser.add_argument(
+        "--validate-cache",
+        help="File of per-file results <validate> reuses for unchanged files",
+        default=validate.DEFAULT_CACHE_PATH,
+    )
+    parser.add_argument(
+        "--resume",
+        help="Continue <trivia_check> after the last checkpointed question",
+        action="store_true",
+    )
     parser.add_argument(
         "--skip",
         help="Number of rows to skip, for resuming previous task",
         default=0,
         type=int,
     )
-    args = parser.parse_args()
+    parser.add_argument(
+        "--concurrency",
+        help="Number of batches to keep in flight to the model at once",
+        default=4,
+        type=int,
+    )
+    parser.add_argument(
+        "--rpm",
+        help="Max model requests per minute (0 = unlimited)",
+        default=0,
+        type=int,
+    )
+    parser.add_argument(
+        "--tpm",
+        help="Max model tokens per minute (0 = unlimited)",
+        default=0,
+        type=int,
+    )
+    parser.add_argument(
+        "--flush-size",
+        help="Number of new questions per batched database write",
+        default=FIRESTORE_MAX_BATCH,
+        type=int,
+    )
+    parser.add_argument(
+        "--index",
+        help="Index of raw input lines that were already processed",
+        default=DEFAULT_INDEX_PATH,
+    )
+    parser.add_argument(
+        "--no-index",
+        help="Don't skip lines that are already in the index",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--export",
+        help="Glob of JSON/JSONL trivia dumps for <rebuild_index>",
+        default="",
+    )
+    parser.add_argument(
+        "--cache",
+        help="File that caches model responses between runs",
+        default=DEFAULT_CACHE_PATH,
+    )
+    parser.add_argument(
+        "--no-cache",
+        help="Always call the model and don't store responses",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--refresh-cache",
+        help="Always call the model, replacing cached responses",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--pack",
+        help="Compiled question pack written by <build_pack>",
+        default=pack.DEFAULT_PACK_PATH,
+    )
+    parser.add_argument(
+        "--clusters",
+        help="""Near-duplicate clusters from <neardup>; in <trivia> only
+        the first question of each cluster is sent to the model""",
+        default=neardup.DEFAULT_CLUSTERS_PATH,
+    )
+    parser.add_argument(
+        "--similarity",
+        help="Jaccard similarity at which <neardup> groups questions",
+        default=neardup.DEFAULT_THRESHOLD,
+        type=float,
+    )
+    parser.add_argument(
+        "--heuristics",
+        help="""Apply the local fixes first and send each line the
+        shortest prompt it needs; .out and .problems then follow input
+        order only per prompt, not overall""",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--batch-tokens",
+        help="Expected completion tokens to pack into each model request",
+        default=BATCH_OUTPUT_TOKENS,
+        type=int,
+    )
+    parser.add_argument(
+        "--retries",
+        help="Retries for rate-limited or failed model calls",
+        default=5,
+        type=int,
+    )
+    parser.add_argument(
+        "--stream",
+        help="""<trivia>: stream model responses and write each question
+        as soon as its line is complete; a cut stream keeps the lines it
+        got and only the rest of the batch is retried""",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--log-level",
+        help="""Log level; INFO drops the per-question and per-prompt
+        DEBUG lines, which slow down large files""",
+        default="DEBUG",
+        choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+    )
+    parser.add_argument(
+        "--progress-interval",
+        help="Seconds between progress lines (0 = none)",
+        default=metrics.DEFAULT_PROGRESS_INTERVAL,
+        type=float,
+    )
+    parser.add_argument(
+        "--metrics-out",
+        help="""Write counters and latency histograms here at the end of
+        the run: a Prometheus textfile if it ends in .prom, else JSON""",
+        default="",
+    )
+    parser.add_argument(
+        "--profile",
+        help="Write a cProfile dump of the run to this file",
+        default="",
+    )
+    parser.add_argument(
+        "--backend",
+        help="""Use the <live> model and database services, or the
+        offline <fake> ones from fakes.py""",
+        default="live",
+        choices=["live", "fake"],
+    )
+    return parser
+
+
+def main():
+    '''Process input files from Open-trivia-database and ask LLM to
+    fix formatting problems and add multiple-choice answers'''
+
+    logging.basicConfig(level=logging.DEBUG)
+    args = build_parser().parse_args()
+    coloredlogs.install(level=args.log_level)
+    install_backends(args)
+
+    profiler = None
+    if args.profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        with metrics.Progress(METRICS, args.progress_interval):
+            return run_mode(args)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+            logger.info('Wrote profile to %s', args.profile)
+        logger.info('Metrics: %s', json.dumps(METRICS.snapshot()))
+        if args.metrics_out:
+            METRICS.write(args.metrics_out)
+
+
+def run_mode(args):
+    """Runs the function for args.mode"""
 
     filename = args.filename
-    BATCH_SIZE = 10
-    lines = 0
 
     logger.info('mode = %s', args.mode)
     if args.mode == "trash" or args.mode == "congrats":
         return banter(filename, args.mode)
-    elif args.mode == "trivia_check":
-        return trivia_check(args.category)
-
-    pathless_filename = os.path.basename(filename)
-    out_file = open(pathless_filename + ".out", "a")
-    problem_file = open(pathless_filename + ".problems", "a")
-
-    # Set up Vertex/PaLM
-    chat_model = ChatModel.from_pretrained(VERTEX_STORY_MODEL)
-    parameters = {
-        "temperature": 0.2,
-        "max_output_tokens": 1024,
-    }
-    chat = chat_model.start_chat(
-        context="You are a code editor for a set of trivia questions stored as JSON objects. Please fix the following trivia questions.",
-        examples=[
-            InputOutputTextPair(
-                input_text="""{"category_id":"SCIENCE_AND_NATURE", "lang":"en", "tags":[], "question":"The phrase "Homo sapiens " means ____", "answer":0, "answers":["Man of knowledge"], "source":""},""",
-                output_text="""{"category_id":"SCIENCE_AND_NATURE", "lang":"en", "tags":[], "question":"The phrase \"Homo sapiens\" means ____", "answer":0, "answers":["Man of knowledge", "Man of science", "Man who thinks", "Man of steel"], "source":"", "explanation":"The phrase \"Homo sapiens\" was first coined by Carl Linnaeus in 1758, a Swedish biologist who created the Latin binomial nomenclature"},""",
-            ),
-            InputOutputTextPair(
-                input_text="""{"category_id":"SCIENCE_AND_NATURE", "lang":"en", "tags":["SCIENCE_AND_NATURE"], "question":"__________ and short_tailed shrews get by on only two hours of sleep a day.", "answer":0, "answers":["Elephants"], "source":""}""",
-                output_text="""{"category_id":"SCIENCE_AND_NATURE", "lang":"en", "tags":["SCIENCE_AND_NATURE"], "question":"__________ and short tailed shrews get by on only two hours of sleep a day.", "answer":0, "answers":["Elephants", "Horses", "Hippos", "Voles"], "source":"", "explanation":"Elephants are the shortest sleeping mammal, and only dream every three to four days"}""",
-            )
-        ],
-    )
+    elif args.mode == "backfill_reviewed":
+        return backfill_reviewed(args.flush_size)
+    elif args.mode == "build_pack":
+        rebuilt, unchanged = pack.build_pack(args.pack)
+        logger.info('Pack %s: rebuilt %s files, %s unchanged',
+                    args.pack, rebuilt, unchanged)
+        return
+    elif args.mode == "neardup":
+        clusters = neardup.find_clusters(
+            glob.glob(filename or os.path.join(
+                pack.REPO_ROOT, "en", "todo", "*.json")), args.similarity)
+        neardup.write_clusters(clusters, args.clusters)
+        return
+    elif args.mode == "fix_local":
+        heuristics.fix_file(
+            filename, journal.output_name(filename) + ".heuristics")
+        return
+    elif args.mode == "status":
+        for path in sorted(glob.glob(filename or "*" + journal.JOURNAL_SUFFIX)):
+            summary = journal.summarize(path)
+            print(json.dumps(summary))
+        return
+    elif args.mode == "sync" or args.mode == "export":
+        return sync_snapshot(state_path(args, args.snapshot),
+                             full=args.mode == "export")
+    elif args.mode == "validate":
+        return validate_files(args)
+    elif args.mode == "rebuild_index":
+        index = InputIndex(args.index)
+        added = input_index.rebuild(
+            index,
+            glob.glob(filename) if filename else [],
+            glob.glob(args.export) if args.export else [])
+        logger.info('Added %s entries, index now has %s', added, len(index))
+        index.close()
+        return
 
-    prompt_template = """For each line in the following JSON array, please perform
-        the following steps:
-        1) Inside the "question" element, escape all
-        unescaped or duplicated quotation marks with a \ character so the line is valid JSON
-        2) Fix unnecessary title casing
-        3) Remove unncessary spaces near quotation marks
-        4) Add three plausible, unique, wrong entries to the `answers` array
-        5) Ensure the "answer" does not appear in the "question"; if there is a "____" in the input, DO NOT REPLACE IT
-        6) Please provide an explanation and interesting factoid in the "explanation" parameter
-        7) Remove the "source" and "tags" parameters
-        8) Please format the output with each object on ONE SINGLE line
+    if args.mode == "trivia" and args.glob:
+        return process_files(args)
 
-        EXAMPLES:
-            input_text={"category_id":"SCIENCE_AND_NATURE", "lang":"en", "tags":[], "question":"The phrase "Homo sapiens " means ____", "answer":0, "answers":["Man of knowledge"], "source":""},
-            output_text={"category_id":"SCIENCE_AND_NATURE", "lang":"en", "question":"The phrase \"Homo sapiens\" means ____", "answer":0, "answers":["Man of knowledge", "Man of science", "Man who thinks", "Man of steel"], "explanation":"The phrase \"Homo sapiens\" was first coined by Carl Linnaeus in 1758, a Swedish biologist who created the Latin binomial nomenclature"},
+    cache = None
+    if not args.no_cache and args.mode in ("trivia", "trivia_check"):
+        cache = ResponseCache(args.cache, refresh=args.refresh_cache)
 
-            input_text={"category_id":"SCIENCE_AND_NATURE", "lang":"en", "tags":["SCIENCE_AND_NATURE"], "question":"__________ and short_tailed shrews get by on only two hours of sleep a day.", "answer":0, "answers":["Elephants"], "source":""},
-            output_text={"category_id":"SCIENCE_AND_NATURE", "lang":"en", "question":"__________ and short tailed shrews get by on only two hours of sleep a day.", "answer":0, "answers":["Elephants", "Horses", "Hippos", "Voles"], "explanation":"Elephants are the shortest sleeping mammal, and only dream every three to four days"},
+    try:
+        if args.mode == "trivia_check":
+            return trivia_check(args.category, cache, args.review_batch,
+                                args.page_size, args.resume,
+                                source=args.source,
+                                snapshot_dir=state_path(args, args.snapshot),
+                                checkpoint_file=state_path(
+                                    args, CHECK_CHECKPOINT_FILE))
+        return process_file(args, cache)
+    finally:
+        if cache is not None:
+            cache.close()
 
-        INPUT:
-        """
 
-    doc_ref = database_handle.collection("trivia")
+def process_file(args, cache, shard=None):
+    """Runs the <trivia> mode over args.filename, or over one shard
+    Args:
+      args: Parsed command line arguments.
+      cache: ResponseCache for model calls, or None.
+      shard: A Shard of lines to process instead of all of args.filename;
+        its output goes to <file>.<first>-<last>.out/.problems.
+    Returns:
+      A Counter of lines "read", "questions" parsed from responses,
+      documents "written", "skipped" lines and documents, and "failed"
+      lines the model gave up on.
+    """
+
+    filename = shard.filename if shard else args.filename
+    # lines read per step; the model batches are packed by tokens
+    READ_SIZE = 10
+    lines = 0
+    counts = Counter()
 
-    with open(filename) as file:
-        # skip first line
-        next_n_lines = list(islice(file, 1))
-        if (args.skip > 0):
-            next_n_lines = list(islice(file, args.skip))
-        while True:
-            logger.info("Processing a batch starting at %s...", lines)
-            lines = lines + BATCH_SIZE
-            next_n_lines = list(islice(file, BATCH_SIZE))
-            if not next_n_lines:
-                break
+    output_prefix = state_path(args, journal.output_name(filename))
+    if shard and not shard.whole_file:
+        output_prefix += ".%d-%d" % (shard.first_line, shard.last_line)
+    out_file = open(output_prefix + ".out", "a")
+    problem_file = open(output_prefix + ".problems", "a")
 
-            # create a concatenated string
-            input_lines = ""
-            for line in next_n_lines:
-                input_lines = input_lines + line
+    writer = None
+    if not args.nodb:
+        writer = QuestionWriter(backend("db"), "trivia", args.flush_size)
+    index = None
+    if not args.no_index:
+        index = InputIndex(args.index)
+    duplicate_lines = {}
+    if os.path.exists(args.clusters):
+        duplicate_lines = neardup.load_duplicate_lines(filename,
+                                                       args.clusters)
+        logger.info('Loaded %s near-duplicate questions to skip',
+                    len(duplicate_lines))
+    limiter = RateLimiter(args.rpm, args.tpm)
+    concurrency = max(args.concurrency, 1)
 
-            logger.info('Submitting to model: input %s',
-                        input_lines)
+    # Lines finished by an earlier run are in the journal; rerunning the
+    # same command after a crash picks up exactly where it stopped.
+    run_journal = Journal(state_path(args, journal_path(filename)), filename)
+    # skip first line, which opens the JSON array, and any resumed rows;
+    # the sidecar offset index turns a large skip into a single seek
+    start = 1 + args.skip
+    if shard:
+        start = max(start, shard.first_line - 1)
+    while start + 1 in run_journal.done_lines:
+        start += 1
+    source_lines = reader.iter_lines(filename, start, use_index=start > 1)
+    if shard:
+        source_lines = takewhile(
+            lambda row: row[0] <= shard.last_line, source_lines)
+    rule_counts = Counter()
+    # items waiting for a full batch, per prompt template
+    buffers = {TRIVIA_PROMPT_TEMPLATE: [], ANSWERS_PROMPT_TEMPLATE: []}
+    # handled batches whose documents are not committed yet, with the
+    # writer's queued count after each; a batch is journaled and indexed
+    # as soon as the write batch holding its last document commits, so a
+    # crash never marks a line done whose question isn't in the db. With
+    # --nodb no question reaches the db, so no answered line is done.
+    uncommitted = deque()
 
-            messages = [
-                {
-                    "role": "system",
-                    "content": "You are a code editor for a set of trivia questions stored as JSON objects. Please fix the following trivia questions.",
-                },
-                {
-                    "role": "user",
-                    "content": prompt_template + input_lines,
-                }
-            ]
-            functions = [
-                {
-                    "name": "ask_trivia_question",
-                    "description": "Ask user trivia question, evaluate answer, and pring explanation",
-                    "parameters": {
-                        "type": "object",
-                        "properties": {
-                            "category_id": {
-                                "type": "string",
-                                "description": "The category of the question, e.g. SCIENCE_AND_NATURE"
-                            },
-                            "lang": {
-                                "type": "string",
-                                "description": "The language code for the question, e.g. en"
-                            },
-                            "question": {
-                                "type": "string",
-                                "description": "Sentence-cased text of the trivia question, with any quotes escaped with '/' "
-                            },
-                            "answer": {
-                                "type": "integer",
-                                "description": "The index of the correct answer from the 'answers' array"
-                            },
-                            "answers": {
-                                "type": "array",
-                                "items": {
-                                    "type": "string"
-                                },
-                                "description": "An array containing possible answer choices"
-                            },
-                            "source": {
-                                "type": "string",
-                                "description": "The source from which the question was derived"
-                            },
-                            "explanation": {
-                                "type": "string",
-                                "description": "A brief explanation or factoid related to the question and answer"
-                            }
-                        }
-                    }
-                }
-            ]
+    def journal_committed():
+        while uncommitted and writer.written >= uncommitted[0][3]:
+            batch, response, questions, _ = uncommitted.popleft()
+            if index is not None:
+                input_index.record_batch(
+                    index, [key for _, key, _ in batch], questions)
+            run_journal.record(
+                [line_number for _, _, line_number in batch], response,
+                [question["content_id"] for question in questions])
 
-            # vertex/PaLM call
-            # response = chat.send_message(
-            #     prompt_template + input_lines,
-            #     **parameters)
-            # response_message = response.text
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        # Batches run concurrently but are consumed in submission order,
+        # so .out and .problems follow input order. With --heuristics
+        # lines are packed per prompt template and local lines need no
+        # batch at all, so the output follows input order only within
+        # each of the three; input lines alternate between templates
+        # every few lines, and batching them in one order would shrink
+        # the batches to match. The journal records line numbers, so
+        # resuming doesn't rely on the order.
+        pending = deque()
 
-            # Chat GPT model
-            response = openai.ChatCompletion.create(
-                model=OPENAI_CHEAP_MODEL,
-                messages=messages,
-                temperature=OPENAI_TEMPERATURE,
-                max_tokens=2500,
-            )
-            response_message = response["choices"][0]["message"]["content"]
+        def submit(template, batch, expected_tokens):
+            input_lines = "".join(line + "\n" for line, _, _ in batch)
+            logger.debug('Submitting to model: input %s', input_lines)
+            if not args.stream:
+                pending.append((
+                    input_lines,
+                    batch,
+                    executor.submit(
+                        complete_packed, batch, limiter, args.retries,
+                        cache, template, expected_tokens),
+                    None))
+                return
 
-            logger.info(f"Response from Model: {response_message}")
-            out_file.write(response_message + "\n")
+            # response lines are handed over as they arrive; None ends
+            # the stream
+            line_queue = queue.Queue()
 
-            # write to DB
-            for response_line in response_message.splitlines():
-                trimmed_line = response_line
-                question_obj = set()
+            def stream():
                 try:
-                    if not trimmed_line.strip():
-                        # skip blank lines
-                        continue
-                    # chomp the trailing , so we can parse this individually
-                    if trimmed_line[-1] == ',':
-                        trimmed_line = trimmed_line[:-1]
-                    question_obj = json.loads(trimmed_line)
-                except json.JSONDecodeError as err:
-                    logger.error(
-                        "Could not parse line '%s', %s @ %s",
-                        response_line,
-                        err.msg,
-                        err.pos)
-                    problem_file.write(response_line + "\n")
-                    continue
+                    return stream_packed(batch, limiter, args.retries, cache,
+                                         template, line_queue.put)
+                finally:
+                    line_queue.put(None)
+            pending.append((input_lines, batch, executor.submit(stream),
+                            line_queue))
 
-                question_obj["random_1"] = int(random.getrandbits(32))
-                question_obj["random_2"] = int(random.getrandbits(32))
-                question_obj["random_3"] = int(random.getrandbits(32))
-                try:
-                    question_obj["correct_answer"] = question_obj["answers"][0]
-                except KeyError as err:
-                    logger.error("Missing answer in question %s (%s)",
-                                 trimmed_line, err)
-                    problem_file.write(response_line + "\n")
-
-                # TODO(mrisher): This hashes based on the post-LLM topic
-                # so potentially we already have an essentially identical
-                # question in the db. In the future, maybe we should hash
-                # based on the raw input question (from the json file)
-                # but then we would need to map the input to output to
-                # get the key
-                # save to database
-                if not args.nodb:
-                    question_key = hashlib.sha1(
-                        question_obj["question"].encode("utf-8")).hexdigest()
-                    if doc_ref.document(question_key).get().exists:
-                        logger.info(
-                            'Already found entry with key %s',
-                            question_key)
-                        continue
-                    logger.info(
-                        "Adding line to database: '%s'",
-                        response_line[:-1])
-                    question_obj["content_id"] = question_key
-                    question_obj["proofed"] = False
-
-                    # remove "answer" key, which was a complicated array index
-                    try:
-                        question_obj.pop("answer")
-                    except (KeyError):
-                        # ignore
-                        logger.debug('question had no "answer" field')
-
-                    doc_ref.document(question_key).set(question_obj)
-
-            # early exit
-            if lines >= args.limit:
-                logger.info('Bailing after %s lines', lines)
+        def submit_full(final):
+            for template, buffer in buffers.items():
+                while True:
+                    batch, expected_tokens = take_batch(
+                        buffer, args.batch_tokens, final)
+                    if batch is None:
+                        break
+                    submit(template, batch, expected_tokens)
+
+        exhausted = False
+        while True:
+            while len(pending) < concurrency and not exhausted:
+                items = []
+                if lines < args.limit:
+                    items = [
+                        (text, raw_line_key(text), line_number)
+                        for line_number, _, text in islice(
+                            source_lines, min(READ_SIZE, args.limit - lines))]
+                if not items:
+                    exhausted = True
+                    break
+                logger.debug("Processing a batch starting at %s...", lines)
+                # lines finished by an earlier run don't count to --limit
+                items = [item for item in items
+                         if item[2] not in run_journal.done_lines]
+                lines = lines + len(items)
+                METRICS.count("lines_read", len(items))
+
+                # drop lines whose question we already processed, and
+                # lines that repeat a question kept elsewhere in the todo
+                # files
+                known = {}
+                if index is not None:
+                    known = index.lookup([key for _, key, _ in items])
+                skipped = {line_number for _, key, line_number in items
+                           if key in known or (
+                               key is not None
+                               and duplicate_lines.get(line_number) == key)}
+                if skipped:
+                    logger.info('Skipping %s processed or duplicate lines',
+                                len(skipped))
+                    counts["skipped"] += len(skipped)
+                    METRICS.count("skipped_duplicates", len(skipped))
+                    run_journal.record(sorted(skipped), skipped=True)
+                    items = [item for item in items
+                             if item[2] not in skipped]
+
+                if not args.heuristics:
+                    buffers[TRIVIA_PROMPT_TEMPLATE].extend(items)
+                else:
+                    local, dropped = route_lines(items, buffers, rule_counts)
+                    if dropped:
+                        run_journal.record(dropped, skipped=True)
+                    if local:
+                        # nothing left for the model to do
+                        finished = Future()
+                        finished.set_result(("\n".join(
+                            line for line, _, _ in local), []))
+                        pending.append(("", local, finished, None))
+
+                submit_full(final=False)
+            if exhausted:
+                submit_full(final=True)
+            if not pending:
                 break
+
+            input_lines, batch, future, line_queue = pending.popleft()
+            if line_queue is None:
+                try:
+                    response_message, unanswered = future.result()
+                except backend("chat").errors as err:
+                    logger.error('Giving up on batch after %s retries: %s',
+                                 args.retries, err)
+                    problem_file.write(input_lines)
+                    counts["failed"] += len(batch)
+                    METRICS.count("llm_errors")
+                    continue
+
+                logger.debug(f"Response from Model: {response_message}")
+                out_file.write(response_message + "\n")
+                out_file.flush()
+
+                # write to DB
+                questions = ingest_response(response_message, writer,
+                                            problem_file)
+            else:
+                # write each line as soon as it arrives, so a cut stream
+                # keeps everything before the cut
+                response_lines = []
+                questions = []
+                for chunk in drain_stream(line_queue):
+                    response_message = "\n".join(chunk)
+                    out_file.write(response_message + "\n")
+                    out_file.flush()
+                    questions.extend(ingest_response(
+                        response_message, writer, problem_file))
+                    response_lines.extend(chunk)
+                response_message = "\n".join(response_lines)
+                unanswered = future.result()
+            if unanswered:
+                problem_file.write("".join(
+                    line + "\n" for line, _, _ in unanswered))
+                counts["failed"] += len(unanswered)
+                METRICS.count("llm_errors")
+                # only the answered lines are done
+                batch = [item for item in batch if item not in unanswered]
+            counts["questions"] += len(questions)
+            METRICS.count("questions_parsed", len(questions))
+            if writer is not None:
+                uncommitted.append((batch, response_message, questions,
+                                    writer.queued))
+                journal_committed()
+
+        if lines >= args.limit:
+            logger.info('Bailing after %s lines', lines)
+    if rule_counts:
+        logger.info('Local fixes: %s', dict(rule_counts))
+    counts["read"] = lines
+    if writer is not None:
+        writer.flush()
+        logger.info('Wrote %s new questions, skipped %s already in db',
+                    writer.written, writer.skipped)
+        counts["written"] = writer.written
+        counts["skipped"] += writer.skipped
+        journal_committed()
+    run_journal.close()
+    if index is not None:
+        index.close()
     out_file.close()
     problem_file.close()
+    return counts
 
     # Then please add plausible but wrong answers to the `answers` array, such that answer[0] is the correct one. Finally, p
     # for line in lines:
@@ -498,5 +1742,80 @@ def main():
     #         print(line)
 
 
+def ingest_shard(args, shard):
+    """Process pool worker: runs process_file over one shard
+    Returns:
+      process_file's counts and a snapshot of this shard's metrics.
+    """
+
+    coloredlogs.install(level=args.log_level)
+    install_backends(args)
+    METRICS.reset()
+    cache = None
+    if not args.no_cache:
+        cache = ResponseCache(args.cache, refresh=args.refresh_cache)
+    try:
+        with metrics.Progress(METRICS, args.progress_interval):
+            counts = process_file(args, cache, shard)
+        return counts, METRICS.snapshot(samples=True)
+    finally:
+        if cache is not None:
+            cache.close()
+
+
+def process_files(args):
+    """Runs the <trivia> mode over every file matching args.glob.
+
+    Files, and line ranges of big files, are spread over a pool of
+    processes that share the --concurrency/--rpm/--tpm budget.
+    Returns:
+      A dict of category to the Counter returned by process_file.
+    """
+
+    shard_list = shards.plan(shards.expand(args.glob), args.shard_lines)
+    if not shard_list:
+        logger.error('No question files match %s', args.glob)
+        return {}
+    processes = max(1, min(args.processes, len(shard_list)))
+    logger.info('Ingesting %s shards with %s processes',
+                len(shard_list), processes)
+
+    # each worker gets an equal slice of the global model budget
+    worker_args = argparse.Namespace(**vars(args))
+    worker_args.concurrency = max(1, args.concurrency // processes)
+    if args.rpm:
+        worker_args.rpm = max(1, args.rpm // processes)
+    if args.tpm:
+        worker_args.tpm = max(1, args.tpm // processes)
+    # the journals say where each shard stopped, --skip doesn't apply
+    worker_args.skip = 0
+    # shards of one file share its journal; write the header up front
+    for filename in sorted({shard.filename for shard in shard_list}):
+        Journal(state_path(args, journal_path(filename)), filename).close()
+
+    results = []
+    # spawn, not fork: the gRPC channels behind the SDK clients don't
+    # survive a fork
+    with ProcessPoolExecutor(
+            max_workers=processes,
+            mp_context=multiprocessing.get_context("spawn")) as executor:
+        futures = {executor.submit(ingest_shard, worker_args, shard): shard
+                   for shard in shard_list}
+        for future in as_completed(futures):
+            shard = futures[future]
+            try:
+                counts, snapshot = future.result()
+                METRICS.merge(snapshot)
+            except Exception as err:
+                logger.error('Shard %s:%s-%s failed: %s', shard.filename,
+                             shard.first_line, shard.last_line, err)
+                counts = Counter(failed=shard.last_line - shard.first_line + 1)
+            results.append((shard, counts))
+
+    totals = shards.merge(results)
+    logger.info('Ingest summary:\n%s', shards.format_summary(totals))
+    return totals
+
+
 if __name__ == "__main__":
     main()
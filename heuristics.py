@@ -0,0 +1,246 @@
+import json
+import logging
+import re
+from collections import Counter, namedtuple
+
+import reader
+
+logger = logging.getLogger(__name__)
+
+MIN_ANSWERS = 4
+# share of capitalized words that still needs the model after fixing
+REWRITE_RATIO = 0.35
+
+_DOUBLE_QUOTED = re.compile(r'"[^"]*"')
+# a title in straight double, curly or single quotes; a single quote
+# against a letter on its outside is an apostrophe
+_QUOTED = re.compile(r'"[^"]*"|“[^”]*”|(?<!\w)\'[^\']*\'(?!\w)')
+_QUOTE_SPACES = re.compile(r'"\s*([^"]*?)\s*"')
+# what mustn't touch a quoted pair from the outside
+_GLUED = re.compile(r'[\w"]')
+_MULTIPLE_SPACES = re.compile(r"\s{2,}")
+_WORD = re.compile(r"[A-Za-z][A-Za-z']*")
+_SENTENCE_END = re.compile(r"[.?!:;]\s*$")
+_BLANK = re.compile(r"_{2,}")
+
+# Words that are only capitalized in Title Casing, never as proper nouns
+_FUNCTION_WORDS = frozenset("""
+a an the and or but nor of in on at to for by with from as into onto over
+under than then so if not no is was were are be been being am has have had
+do does did which who whom whose what when where why how that this these
+those it its his her their he she they we you your our my me him them
+""".split())
+
+# A fixed question plus the names of the rules that changed it.
+# needs_rewrite: text problems remain that only the model can fix.
+# needs_answers: the model still has to add wrong answers/explanation.
+Result = namedtuple(
+    "Result", ["question", "rules", "needs_rewrite", "needs_answers"])
+
+
+def _outside_quotes(text):
+    return _QUOTED.sub(" ", text)
+
+
+def is_title_case(text, ratio=0.6):
+    """True if most words after the first (outside quotes) are capitalized"""
+    words = _WORD.findall(_outside_quotes(text))[1:]
+    if len(words) < 3:
+        return False
+    capitalized = sum(1 for word in words if word[0].isupper())
+    return capitalized / len(words) >= ratio
+
+
+def _lower_function_words(text):
+    """Lowercases capitalized function words that don't start a sentence
+    and aren't inside a quoted title"""
+    pieces = []
+    position = 0
+    for quoted in list(_QUOTED.finditer(text)) + [None]:
+        end = quoted.start() if quoted else len(text)
+        segment = text[position:end]
+
+        def lower(match):
+            start = position + match.start()
+            if start == 0 or _SENTENCE_END.search(text[:start]):
+                return match.group(0)
+            word = match.group(0)
+            # single letters are left alone: Vitamin A, option A)
+            if (word.lower() in _FUNCTION_WORDS
+                    and len(word) > 1 and word[1:].islower()):
+                return word.lower()
+            return word
+
+        pieces.append(_WORD.sub(lower, segment))
+        if quoted:
+            pieces.append(quoted.group(0))
+            position = quoted.end()
+    return "".join(pieces)
+
+
+def answer_in_question(question, answer):
+    """Returns a match if the answer appears as whole words in the question"""
+    if not answer.strip():
+        return None
+    return re.search(r"(?<!\w)" + re.escape(answer.strip()) + r"(?!\w)",
+                     question, re.IGNORECASE)
+
+
+def blank_answer(question, answer):
+    """Replaces the answer in the question with a blank, keeping the case of
+    the rest of the question"""
+    return re.sub(r"(?<!\w)" + re.escape(answer.strip()) + r"(?!\w)",
+                  "_____", question, flags=re.IGNORECASE)
+
+
+def quotes_pair(text):
+    """True if the quotes pair up cleanly: an even number of them, and
+    no pair empty or touching a letter or another quote on its outside.
+    Otherwise pairing them can join text across pairs, as in
+    'Rhythm is a Dancer"By Snap'."""
+    if text.count('"') % 2 == 1:
+        return False
+    for quoted in _DOUBLE_QUOTED.finditer(text):
+        before = text[max(0, quoted.start() - 1):quoted.start()]
+        after = text[quoted.end():quoted.end() + 1]
+        if (quoted.group(0) == '""' or _GLUED.match(before)
+                or _GLUED.match(after)):
+            return False
+    return True
+
+
+def _trim(question_obj):
+    text = question_obj["question"]
+    answers = question_obj["answers"]
+    question_obj["question"] = text.strip()
+    question_obj["answers"] = [answer.strip() for answer in answers]
+    return question_obj["question"] != text or question_obj["answers"] != answers
+
+
+def _collapse_spaces(question_obj):
+    text = question_obj["question"]
+    question_obj["question"] = _MULTIPLE_SPACES.sub(" ", text)
+    return question_obj["question"] != text
+
+
+def _stray_trailing_quote(question_obj):
+    text = question_obj["question"]
+    if text.count('"') % 2 == 1 and text.endswith('"'):
+        question_obj["question"] = text[:-1].rstrip()
+        return True
+    return False
+
+
+def _quote_spaces(question_obj):
+    text = question_obj["question"]
+    if not quotes_pair(text):
+        return False
+    question_obj["question"] = _QUOTE_SPACES.sub(r'"\1"', text)
+    return question_obj["question"] != text
+
+
+def _title_case(question_obj):
+    text = question_obj["question"]
+    # quoted titles are kept as is, which needs the quotes to pair up
+    if not quotes_pair(text) or not is_title_case(text):
+        return False
+    question_obj["question"] = _lower_function_words(text)
+    return question_obj["question"] != text
+
+
+def _gives_answer_away(question_obj):
+    # the answer can show up legitimately, as in 'In "Romeo and Juliet",
+    # who said...', so only the model may rewrite it
+    text = question_obj["question"]
+    answer = question_obj["answers"][question_obj.get("answer", 0)]
+    return (not _BLANK.search(text)
+            and answer_in_question(text, answer) is not None)
+
+
+# Applied in order; each returns True if it changed the question
+RULES = (
+    ("trim", _trim),
+    ("collapse_spaces", _collapse_spaces),
+    ("stray_trailing_quote", _stray_trailing_quote),
+    ("quote_spaces", _quote_spaces),
+    ("title_case", _title_case),
+)
+
+
+def fix_question(question_obj):
+    """Applies every rule to a parsed question from a todo file.
+    Returns:
+      A Result with a fixed copy of the question, without the "source"
+      and "tags" fields the model would drop anyway.
+    """
+
+    question_obj = dict(question_obj)
+    question_obj.pop("source", None)
+    question_obj.pop("tags", None)
+    answers = question_obj.get("answers")
+    answer = question_obj.get("answer", 0)
+    if (not isinstance(question_obj.get("question"), str)
+            or not isinstance(answers, list)
+            or not all(isinstance(text, str) for text in answers)
+            or not isinstance(answer, int)
+            or not 0 <= answer < len(answers)):
+        return Result(question_obj, [], True, True)
+
+    # lowering function words alone leaves Title Casing behind, as in
+    # "Hanoi is the Capital of which Country", so the model rewrites
+    # every title-cased question
+    title_cased = is_title_case(question_obj["question"])
+    rules = [name for name, rule in RULES if rule(question_obj)]
+    text = question_obj["question"]
+    needs_rewrite = (title_cased or is_title_case(text, REWRITE_RATIO)
+                     or not quotes_pair(text)
+                     or _gives_answer_away(question_obj))
+    needs_answers = (len(question_obj["answers"]) < MIN_ANSWERS
+                     or not question_obj.get("explanation"))
+    return Result(question_obj, rules, needs_rewrite, needs_answers)
+
+
+def fix_line(line):
+    """Fixes one raw line of a question file.
+    Returns:
+      A Result, or None for lines that only open/close the array. Lines
+      that aren't valid JSON come back unchanged with needs_rewrite set.
+    """
+
+    if reader.is_structural(line):
+        return None
+    question_obj = reader.parse_json_line(line)
+    if question_obj is None:
+        return Result(None, [], True, True)
+    return fix_question(question_obj)
+
+
+def fix_file(filename, report_filename):
+    """Runs the rules over a whole file in one pass.
+
+    Writes one JSON object per question to `report_filename` with the
+    line number, the rules that fired, whether the model is still needed
+    and the fixed question.
+    Returns:
+      A Counter of rule names plus "needs_rewrite"/"needs_answers"/"lines".
+    """
+
+    counts = Counter()
+    with open(report_filename, "w") as report:
+        for line_number, _, text in reader.iter_lines(filename):
+            result = fix_line(text)
+            if result is None:
+                continue
+            counts["lines"] += 1
+            counts.update(result.rules)
+            counts["needs_rewrite"] += result.needs_rewrite
+            counts["needs_answers"] += result.needs_answers
+            report.write(json.dumps({
+                "line": line_number,
+                "rules": result.rules,
+                "needs_rewrite": result.needs_rewrite,
+                "needs_answers": result.needs_answers,
+                "question": result.question if result.question else text,
+            }, ensure_ascii=False) + "\n")
+    logger.info('%s: %s', filename, dict(counts))
+    return counts
@@ -0,0 +1,162 @@
+import hashlib
+import logging
+import re
+import sqlite3
+import unicodedata
+
+from reader import is_structural, parse_json_line
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_INDEX_PATH = "input_index.sqlite3"
+
+_NON_WORD = re.compile(r"[\W_]+", re.UNICODE)
+# Raw todo lines often aren't valid JSON (unescaped quotes are one of the
+# things the model fixes), so fall back to pulling the fields out by hand.
+_RAW_QUESTION = re.compile(r'"question"\s*:\s*"(.*?)"\s*,\s*"answer"\s*:')
+_RAW_FIRST_ANSWER = re.compile(r'"answers"\s*:\s*\[\s*"(.*?)"\s*[,\]]')
+
+
+def normalize_text(text):
+    """Lowercases text and drops accents, punctuation and extra spaces"""
+    if not text.isascii():
+        text = unicodedata.normalize("NFKD", text)
+        text = "".join(c for c in text if not unicodedata.combining(c))
+    return _NON_WORD.sub(" ", text.lower()).strip()
+
+
+def input_key(question, correct_answer):
+    """Hashes the normalized question and correct answer.
+
+    Casing, quoting and spacing differences (what the model usually fixes)
+    hash to the same key, so a raw todo line and the question the model
+    produced from it normally share a key.
+    """
+    normalized = normalize_text(question) + "\n" + normalize_text(correct_answer)
+    return hashlib.sha1(normalized.encode("utf-8")).hexdigest()
+
+
+def question_key(question_obj):
+    """Returns the input key of a parsed question, or None"""
+    try:
+        if "correct_answer" in question_obj:
+            answer = question_obj["correct_answer"]
+        else:
+            answer = question_obj["answers"][question_obj.get("answer", 0)]
+        return input_key(question_obj["question"], answer)
+    except (KeyError, IndexError, TypeError):
+        return None
+
+
+def raw_line_key(line):
+    """Returns the input key of a raw line from a question file, or None"""
+    question_obj = parse_json_line(line)
+    if question_obj is not None:
+        return question_key(question_obj)
+    if is_structural(line):
+        return None
+    question = _RAW_QUESTION.search(line)
+    answer = _RAW_FIRST_ANSWER.search(line)
+    if question is None or answer is None:
+        return None
+    return input_key(question.group(1), answer.group(1))
+
+
+class InputIndex:
+    """Persistent map from input keys to the content_id they produced"""
+
+    def __init__(self, path=DEFAULT_INDEX_PATH):
+        self.path = path
+        # several --glob worker processes can share the file
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS inputs (
+                input_key TEXT PRIMARY KEY,
+                content_id TEXT NOT NULL)""")
+        self._conn.commit()
+
+    def __len__(self):
+        return self._conn.execute("SELECT COUNT(*) FROM inputs").fetchone()[0]
+
+    def lookup(self, keys):
+        """Returns {input_key: content_id} for the keys that are indexed"""
+        found = {}
+        keys = [key for key in set(keys) if key is not None]
+        # stay under SQLite's bound-parameter limit
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            rows = self._conn.execute(
+                "SELECT input_key, content_id FROM inputs WHERE input_key IN (%s)"
+                % ",".join("?" * len(chunk)), chunk)
+            found.update(rows)
+        return found
+
+    def add(self, pairs):
+        """Records (input_key, content_id) pairs"""
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO inputs VALUES (?, ?)",
+            [(key, content_id) for key, content_id in pairs if key is not None])
+        self._conn.commit()
+
+    def close(self):
+        self._conn.close()
+
+
+def record_batch(index, input_keys, questions):
+    """Maps a batch of raw input keys to the questions the model returned.
+
+    If the model returned one question per input line they are matched by
+    position, otherwise only by equal keys. Unmatched inputs, and lines
+    without a key, are left out and will be sent to the model again next
+    time.
+    """
+
+    pairs = [(question_key(question), question["content_id"])
+             for question in questions]
+    if len(input_keys) == len(questions):
+        pairs.extend((key, question["content_id"])
+                     for key, question in zip(input_keys, questions))
+    index.add(pairs)
+
+
+def _iter_json_objects(filename):
+    """Yields dicts from a JSON array file or a one-object-per-line file"""
+    with open(filename, encoding="utf-8") as file:
+        for line in file:
+            question_obj = parse_json_line(line.strip().lstrip("[").rstrip("]"))
+            if question_obj is None:
+                logger.debug('Skipping unparseable line in %s', filename)
+                continue
+            yield question_obj
+
+
+def rebuild(index, out_files=(), export_files=()):
+    """Adds entries from previous runs to the index.
+    Args:
+      index: InputIndex to fill.
+      out_files: `.out` files written by the trivia mode.
+      export_files: JSON/JSONL dumps of `trivia` documents.
+    Returns:
+      The number of entries added.
+    """
+
+    added = 0
+    for filename in out_files:
+        pairs = []
+        for question_obj in _iter_json_objects(filename):
+            if "question" not in question_obj:
+                continue
+            content_id = hashlib.sha1(
+                question_obj["question"].encode("utf-8")).hexdigest()
+            pairs.append((question_key(question_obj), content_id))
+        index.add(pairs)
+        added += len(pairs)
+        logger.info('Indexed %s questions from %s', len(pairs), filename)
+    for filename in export_files:
+        pairs = [(question_key(doc), doc["content_id"])
+                 for doc in _iter_json_objects(filename)
+                 if "content_id" in doc]
+        index.add(pairs)
+        added += len(pairs)
+        logger.info('Indexed %s documents from %s', len(pairs), filename)
+    return added
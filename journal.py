@@ -0,0 +1,127 @@
+import hashlib
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+JOURNAL_SUFFIX = ".journal"
+
+
+def output_name(filename):
+    """Base name of the .out, .problems and journal files for an input
+    file: its path relative to the working directory with the
+    separators replaced, so en/todo/music.json and fr/todo/music.json
+    don't share them. Files outside it use their absolute path."""
+    path = os.path.relpath(filename)
+    if path.startswith(os.pardir + os.sep):
+        path = os.path.abspath(filename).lstrip(os.sep)
+    return path.replace(os.sep, "_")
+
+
+def journal_path(filename):
+    """Journal for an input file, next to its .out and .problems files"""
+    return output_name(filename) + JOURNAL_SUFFIX
+
+
+def load(path):
+    """Returns the entries of a journal, ignoring a torn last line"""
+    entries = []
+    try:
+        with open(path) as file:
+            for line in file:
+                try:
+                    entries.append(json.loads(line))
+                except json.JSONDecodeError:
+                    logger.warning('Ignoring incomplete journal entry in %s',
+                                   path)
+    except FileNotFoundError:
+        pass
+    return entries
+
+
+class Journal:
+    """Append-only record of the input lines a run has finished.
+
+    Every entry is fsynced before the next batch is handled, so after a
+    crash a rerun knows exactly which lines were done, which model
+    response they came from and which documents they produced.
+
+    Raises:
+      ValueError: The journal was started for another input file.
+    """
+
+    def __init__(self, path, source):
+        self.path = path
+        self.done_lines = set()
+        entries = load(path)
+        recorded = entries[0].get("source") if entries else None
+        if recorded is not None and (os.path.realpath(recorded)
+                                     != os.path.realpath(source)):
+            raise ValueError("Journal %s is for %s, not %s"
+                             % (path, recorded, source))
+        for entry in entries:
+            self.done_lines.update(entry.get("lines", ()))
+        self._file = open(path, "a")
+        if not entries:
+            self._append({"source": os.path.abspath(source),
+                          "started": time.time()})
+        elif self.done_lines:
+            logger.info('Journal %s: %s lines already done', path,
+                        len(self.done_lines))
+
+    def _append(self, entry):
+        self._file.write(json.dumps(entry) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def record(self, line_numbers, response=None, keys=(), skipped=False):
+        """Marks input lines as done.
+        Args:
+          line_numbers: 1-based line numbers in the input file.
+          response: The model response they were sent in, if any.
+          keys: content_ids written to the database for them.
+          skipped: The lines were dropped without calling the model.
+        """
+
+        entry = {"lines": sorted(line_numbers), "time": time.time()}
+        if response is not None:
+            entry["response_sha1"] = hashlib.sha1(
+                response.encode("utf-8")).hexdigest()
+        if keys:
+            entry["keys"] = list(keys)
+        if skipped:
+            entry["skipped"] = True
+        self._append(entry)
+        self.done_lines.update(line_numbers)
+
+    def close(self):
+        self._file.close()
+
+
+def summarize(path):
+    """Returns progress and throughput numbers for one journal"""
+    entries = load(path)
+    summary = {"journal": path, "source": None, "done_lines": 0,
+               "skipped_lines": 0, "written": 0, "batches": 0,
+               "started": None, "last": None, "lines_per_minute": None}
+    done_lines = set()
+    for entry in entries:
+        if "source" in entry:
+            summary["source"] = entry["source"]
+            summary["started"] = entry["started"]
+            continue
+        done_lines.update(entry["lines"])
+        if entry.get("skipped"):
+            summary["skipped_lines"] += len(entry["lines"])
+        else:
+            summary["batches"] += 1
+        summary["written"] += len(entry.get("keys", ()))
+        summary["last"] = entry["time"]
+    summary["done_lines"] = len(done_lines)
+    if summary["started"] and summary["last"]:
+        minutes = (summary["last"] - summary["started"]) / 60
+        if minutes > 0:
+            summary["lines_per_minute"] = summary["done_lines"] / minutes
+    return summary
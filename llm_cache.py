@@ -0,0 +1,117 @@
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+from metrics import METRICS
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_PATH = "llm_cache.sqlite3"
+DEFAULT_MAX_ENTRIES = 200000
+DEFAULT_MAX_AGE_DAYS = 90
+
+
+def cache_key(model, temperature, prompt):
+    """Hashes everything that determines a model response"""
+    payload = json.dumps(
+        {"model": model, "temperature": temperature, "prompt": prompt},
+        sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """Disk-backed cache of raw model responses.
+
+    Entries older than `max_age_days` are dropped, and the least recently
+    used entries are dropped once there are more than `max_entries`.
+    With `refresh=True` lookups always miss but responses are still stored,
+    which replaces stale entries. Safe to share between threads.
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH,
+                 max_entries=DEFAULT_MAX_ENTRIES,
+                 max_age_days=DEFAULT_MAX_AGE_DAYS,
+                 refresh=False):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age_days = max_age_days
+        self.refresh = refresh
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # several --glob worker processes can share the file
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                model TEXT NOT NULL,
+                response TEXT NOT NULL,
+                created REAL NOT NULL,
+                last_used REAL NOT NULL)""")
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS responses_last_used"
+            " ON responses (last_used)")
+        self._conn.commit()
+        self.evict()
+
+    def get(self, model, temperature, prompt):
+        """Returns the cached response text, or None"""
+        key = cache_key(model, temperature, prompt)
+        with self._lock:
+            row = None
+            if not self.refresh:
+                row = self._conn.execute(
+                    "SELECT response FROM responses WHERE key = ?",
+                    (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                METRICS.count("llm_cache_misses")
+                return None
+            self.hits += 1
+            METRICS.count("llm_cache_hits")
+            self._conn.execute(
+                "UPDATE responses SET last_used = ? WHERE key = ?",
+                (time.time(), key))
+            self._conn.commit()
+            return row[0]
+
+    def put(self, model, temperature, prompt, response):
+        """Stores the response text for a prompt"""
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                (cache_key(model, temperature, prompt), model, response,
+                 now, now))
+            self._conn.commit()
+
+    def get_or_call(self, model, temperature, prompt, call):
+        """Returns the cached response, or stores and returns `call()`"""
+        response = self.get(model, temperature, prompt)
+        if response is None:
+            response = call()
+            self.put(model, temperature, prompt, response)
+        return response
+
+    def evict(self):
+        """Drops expired entries, then the least recently used overflow"""
+        with self._lock:
+            if self.max_age_days:
+                self._conn.execute(
+                    "DELETE FROM responses WHERE created < ?",
+                    (time.time() - self.max_age_days * 86400,))
+            if self.max_entries:
+                self._conn.execute(
+                    """DELETE FROM responses WHERE key IN (
+                        SELECT key FROM responses
+                        ORDER BY last_used DESC LIMIT -1 OFFSET ?)""",
+                    (self.max_entries,))
+            self._conn.commit()
+
+    def close(self):
+        self.evict()
+        logger.info('Model cache: %s hits, %s misses', self.hits, self.misses)
+        self._conn.close()
@@ -0,0 +1,205 @@
+import json
+import logging
+import os
+import random
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# Observations kept per histogram for percentiles (reservoir sampling)
+RESERVOIR_SIZE = 2048
+DEFAULT_PROGRESS_INTERVAL = 30
+PROMETHEUS_PREFIX = "trivia_fixer_"
+
+
+def _new_histogram():
+    return {"buckets": [0] * (len(LATENCY_BUCKETS) + 1), "sum": 0.0,
+            "count": 0, "samples": []}
+
+
+def percentile(samples, fraction):
+    """Nearest-rank percentile of a list of observations, or None"""
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class Metrics:
+    """Thread-safe counters and latency histograms for one run.
+
+    Counters are plain names such as "llm_calls" or "firestore_writes".
+    A histogram keeps per-bucket counts plus the sum and count of its
+    observations, the same shape a Prometheus histogram has, and a
+    uniform sample of the observations for p50/p99.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._rng = random.Random(0)
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.started = time.time()
+            self.counters = Counter()
+            self.histograms = {}
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    def observe(self, name, seconds):
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = _new_histogram()
+            histogram["buckets"][bisect_left(LATENCY_BUCKETS, seconds)] += 1
+            histogram["sum"] += seconds
+            histogram["count"] += 1
+            samples = histogram["samples"]
+            if len(samples) < RESERVOIR_SIZE:
+                samples.append(seconds)
+            else:
+                slot = self._rng.randrange(histogram["count"])
+                if slot < RESERVOIR_SIZE:
+                    samples[slot] = seconds
+
+    @contextmanager
+    def timer(self, name):
+        """Records how long the block took in histogram `name`, whether or
+        not it raised"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def snapshot(self, samples=False):
+        """Returns a JSON-serializable copy of every counter and histogram
+        Args:
+          samples: Include the sampled observations, so merge() can
+            combine percentiles across processes.
+        """
+
+        with self._lock:
+            histograms = {}
+            for name, histogram in sorted(self.histograms.items()):
+                histograms[name] = {
+                    "buckets": list(histogram["buckets"]),
+                    "sum": histogram["sum"],
+                    "count": histogram["count"],
+                    "p50": percentile(histogram["samples"], 0.5),
+                    "p99": percentile(histogram["samples"], 0.99),
+                }
+                if samples:
+                    histograms[name]["samples"] = list(histogram["samples"])
+            return {
+                "elapsed_seconds": time.time() - self.started,
+                "counters": dict(sorted(self.counters.items())),
+                "histograms": histograms,
+            }
+
+    def merge(self, snapshot):
+        """Adds a snapshot taken in another process, e.g. a pool worker"""
+        with self._lock:
+            self.counters.update(snapshot["counters"])
+            for name, other in snapshot["histograms"].items():
+                histogram = self.histograms.get(name)
+                if histogram is None:
+                    histogram = self.histograms[name] = _new_histogram()
+                histogram["buckets"] = [
+                    mine + theirs for mine, theirs
+                    in zip(histogram["buckets"], other["buckets"])]
+                histogram["sum"] += other["sum"]
+                histogram["count"] += other["count"]
+                histogram["samples"].extend(other.get("samples", ()))
+                if len(histogram["samples"]) > RESERVOIR_SIZE:
+                    histogram["samples"] = self._rng.sample(
+                        histogram["samples"], RESERVOIR_SIZE)
+
+    def progress_line(self):
+        """One line with every counter and the mean of every histogram"""
+        snapshot = self.snapshot()
+        fields = ["%s=%s" % item for item in snapshot["counters"].items()]
+        for name, histogram in snapshot["histograms"].items():
+            if histogram["count"]:
+                fields.append("%s_avg=%.3f" % (
+                    name, histogram["sum"] / histogram["count"]))
+        return "%.0fs %s" % (snapshot["elapsed_seconds"], " ".join(fields))
+
+    def to_prometheus(self, prefix=PROMETHEUS_PREFIX):
+        """Renders the metrics in the Prometheus text exposition format"""
+        snapshot = self.snapshot()
+        lines = []
+        for name, value in snapshot["counters"].items():
+            lines.append("# TYPE %s%s_total counter" % (prefix, name))
+            lines.append("%s%s_total %s" % (prefix, name, value))
+        for name, histogram in snapshot["histograms"].items():
+            metric = prefix + name
+            lines.append("# TYPE %s histogram" % metric)
+            cumulative = 0
+            for bound, bucket in zip(LATENCY_BUCKETS, histogram["buckets"]):
+                cumulative += bucket
+                lines.append('%s_bucket{le="%s"} %s'
+                             % (metric, bound, cumulative))
+            lines.append('%s_bucket{le="+Inf"} %s'
+                         % (metric, histogram["count"]))
+            lines.append("%s_sum %s" % (metric, histogram["sum"]))
+            lines.append("%s_count %s" % (metric, histogram["count"]))
+        lines.append("# TYPE %selapsed_seconds gauge" % prefix)
+        lines.append("%selapsed_seconds %s"
+                     % (prefix, snapshot["elapsed_seconds"]))
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """Writes a Prometheus textfile if path ends in .prom, else JSON.
+        The file is replaced atomically, as the textfile collector needs.
+        """
+
+        if path.endswith(".prom"):
+            text = self.to_prometheus()
+        else:
+            text = json.dumps(self.snapshot(), indent=1) + "\n"
+        temp_path = path + ".tmp"
+        with open(temp_path, "w") as file:
+            file.write(text)
+        os.replace(temp_path, path)
+
+
+# The registry every module records into
+METRICS = Metrics()
+
+
+class Progress:
+    """Logs a progress line every `interval` seconds while the block runs.
+    An interval of 0 turns it off.
+    """
+
+    def __init__(self, metrics=METRICS, interval=DEFAULT_PROGRESS_INTERVAL):
+        self.metrics = metrics
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            logger.info('Progress: %s', self.metrics.progress_line())
+
+    def __enter__(self):
+        if self.interval > 0:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+        return False
@@ -0,0 +1,158 @@
+import difflib
+import json
+import logging
+import math
+import os
+from collections import Counter, namedtuple
+
+import reader
+from input_index import normalize_text, question_key
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CLUSTERS_PATH = "neardup_clusters.json"
+DEFAULT_THRESHOLD = 0.6
+# Words at least this similar are taken for spellings of the same word
+SPELLING_SIMILARITY = 0.8
+
+Member = namedtuple("Member", ["source", "line_number", "question", "key"])
+
+
+def correct_answer(question_obj):
+    """The normalized text of a question's correct answer, or "" """
+    try:
+        answer = question_obj["answers"][question_obj.get("answer", 0)]
+    except (KeyError, IndexError, TypeError):
+        return ""
+    return normalize_text(answer) if isinstance(answer, str) else ""
+
+
+def shingles(question_obj):
+    """Word unigrams and bigrams of the normalized question and answer"""
+    words = normalize_text(question_obj.get("question", "")).split()
+    result = set(words)
+    result.update(" ".join(pair) for pair in zip(words, words[1:]))
+    result.update("answer:" + word
+                  for word in correct_answer(question_obj).split())
+    return result
+
+
+def _substituted(first_words, second_words):
+    """True if each question has a word the other lacks that isn't just a
+    different spelling of one of its words, as in "...currency for
+    Australia" and "...currency for Bahamas": those ask different things
+    however much else they share"""
+    first_only = first_words - second_words
+    second_only = second_words - first_words
+    if not first_only or not second_only:
+        return False
+    return not all(difflib.get_close_matches(word, second_only, 1,
+                                             SPELLING_SIMILARITY)
+                   for word in first_only)
+
+
+def _jaccard(first, second):
+    if not first and not second:
+        return 1.0
+    return len(first & second) / len(first | second)
+
+
+def find_clusters(filenames, threshold=DEFAULT_THRESHOLD):
+    """Groups near-duplicate questions across question files.
+
+    Questions are read in file order, and the first question of each
+    cluster is the one kept. A question joins the cluster whose kept
+    question it matches best, and starts a new cluster if it matches
+    none. Matching is never transitive: two questions match when their
+    normalized correct answers are equal, the Jaccard similarity of
+    their shingle sets is at least `threshold`, and neither swaps a word
+    of the other for a different one. Candidates come from a
+    prefix-filtered inverted index of the kept questions, which finds
+    every match without comparing all pairs (unlike MinHash LSH it has
+    no false negatives).
+    Args:
+      filenames: Question files to scan.
+      threshold: Minimum Jaccard similarity for two questions to match.
+    Returns:
+      A list of clusters with more than one member, each a list of
+      Member tuples in file order; the first member is the one to keep.
+    """
+
+    members = []
+    shingle_sets = []
+    answers = []
+    words = []
+    for filename in sorted(filenames):
+        for record in reader.iter_questions(filename):
+            members.append(Member(filename, record.line_number,
+                                  record.question.get("question", ""),
+                                  question_key(record.question)))
+            shingle_sets.append(shingles(record.question))
+            answers.append(correct_answer(record.question))
+            words.append(set(normalize_text(
+                record.question.get("question", "")).split()))
+
+    # Prefix filtering: order each set rarest token first. Two sets can
+    # only reach `threshold` if they share a token within the first
+    # n - ceil(threshold * n) + 1 tokens of each, so only those tokens
+    # of the kept questions are indexed, and probed for the others.
+    frequency = Counter(token for shingle_set in shingle_sets
+                        for token in shingle_set)
+    clusters = {}
+    postings = {}
+    for item, shingle_set in enumerate(shingle_sets):
+        size = len(shingle_set)
+        prefix = sorted(shingle_set, key=lambda token: (frequency[token], token))
+        prefix = prefix[:size - math.ceil(threshold * size) + 1]
+        candidates = set()
+        for token in prefix:
+            candidates.update(postings.get(token, ()))
+        # the most similar kept question wins, the earliest on a tie
+        best, best_similarity = None, 0.0
+        for kept in sorted(candidates):
+            kept_size = len(shingle_sets[kept])
+            if (answers[kept] != answers[item]
+                    or min(size, kept_size) < threshold * max(size, kept_size)):
+                continue
+            similarity = _jaccard(shingle_set, shingle_sets[kept])
+            if (similarity >= threshold and similarity > best_similarity
+                    and not _substituted(words[item], words[kept])):
+                best, best_similarity = kept, similarity
+        if best is not None:
+            clusters[best].append(members[item])
+            continue
+        clusters[item] = [members[item]]
+        for token in prefix:
+            postings.setdefault(token, []).append(item)
+
+    result = [cluster for cluster in clusters.values() if len(cluster) > 1]
+    logger.info('Found %s near-duplicate clusters covering %s of %s questions',
+                len(result), sum(len(cluster) for cluster in result),
+                len(members))
+    return result
+
+
+def write_clusters(clusters, path=DEFAULT_CLUSTERS_PATH):
+    with open(path, "w") as file:
+        json.dump({"clusters": [[member._asdict() for member in cluster]
+                                for cluster in clusters]},
+                  file, indent=1, ensure_ascii=False)
+
+
+def load_duplicate_lines(filename, path=DEFAULT_CLUSTERS_PATH):
+    """Returns {line number: input key} for the members of one question
+    file that aren't the first of their cluster.
+
+    Members are matched by line, not key: casing and punctuation variants
+    share the kept question's key. The key lets a caller check that the
+    line still holds the question it had when the clusters were found.
+    """
+
+    with open(path) as file:
+        clusters = json.load(file)["clusters"]
+    source = os.path.realpath(filename)
+    return {member["line_number"]: member["key"]
+            for cluster in clusters
+            for member in cluster[1:]
+            if member["key"] is not None
+            and os.path.realpath(member["source"]) == source}
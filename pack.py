@@ -0,0 +1,279 @@
+import glob
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+from array import array
+
+import reader
+
+logger = logging.getLogger(__name__)
+
+REPO_ROOT = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_PACK_PATH = "questions.pack.sqlite3"
+LANGUAGES = ("en", "fr")
+BANTER_FILES = ("trash.json", "congrats.json")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS strings (
+    id INTEGER PRIMARY KEY,
+    value TEXT NOT NULL UNIQUE);
+CREATE TABLE IF NOT EXISTS sources (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    sha1 TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS questions (
+    id INTEGER PRIMARY KEY,
+    source TEXT NOT NULL,
+    line_number INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    category INTEGER,
+    lang INTEGER,
+    difficulty TEXT,
+    body TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS questions_source ON questions (source);
+CREATE TABLE IF NOT EXISTS question_tags (
+    question INTEGER NOT NULL,
+    tag INTEGER NOT NULL);
+CREATE INDEX IF NOT EXISTS question_tags_question ON question_tags (question);
+CREATE TABLE IF NOT EXISTS banter (
+    id INTEGER PRIMARY KEY,
+    source TEXT NOT NULL,
+    type TEXT NOT NULL,
+    body TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS postings (
+    kind TEXT NOT NULL,
+    value INTEGER NOT NULL,
+    ids BLOB NOT NULL,
+    PRIMARY KEY (kind, value));
+"""
+
+
+def question_files(root=REPO_ROOT):
+    """Returns every question file under the language folders"""
+    files = []
+    for lang in LANGUAGES:
+        files.extend(glob.glob(os.path.join(root, lang, "**", "*.json"),
+                               recursive=True))
+    return sorted(files)
+
+
+def status_for(relative_path):
+    """Maps en/todo/x.json to "todo", en/x.json to "validated", etc."""
+    parts = relative_path.replace(os.sep, "/").split("/")
+    if len(parts) > 2:
+        return parts[1]
+    return "validated"
+
+
+def file_sha1(filename):
+    digest = hashlib.sha1()
+    with open(filename, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _intern(conn, strings, value):
+    if value is None:
+        return None
+    if value not in strings:
+        conn.execute("INSERT OR IGNORE INTO strings (value) VALUES (?)",
+                     (value,))
+        strings[value] = conn.execute(
+            "SELECT id FROM strings WHERE value = ?", (value,)).fetchone()[0]
+    return strings[value]
+
+
+def _load_questions(conn, strings, filename, relative_path):
+    status = status_for(relative_path)
+    loaded = 0
+
+    def on_malformed(malformed):
+        logger.warning('%s:%s: %s', relative_path, malformed.line_number,
+                       malformed.error)
+
+    for record in reader.iter_questions(filename, on_malformed=on_malformed):
+        question = record.question
+        cursor = conn.execute(
+            "INSERT INTO questions (source, line_number, status, category,"
+            " lang, difficulty, body) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (relative_path, record.line_number, status,
+             _intern(conn, strings, question.get("category_id")),
+             _intern(conn, strings, question.get("lang")),
+             question.get("difficulty"),
+             json.dumps(question, ensure_ascii=False)))
+        tags = question.get("tags") or []
+        conn.executemany(
+            "INSERT INTO question_tags VALUES (?, ?)",
+            [(cursor.lastrowid, _intern(conn, strings, tag))
+             for tag in set(tags) if isinstance(tag, str)])
+        loaded += 1
+    return loaded
+
+
+def _load_banter(conn, filename, relative_path):
+    banter_type = os.path.splitext(os.path.basename(filename))[0]
+    with open(filename) as file:
+        banter_array = json.load(file)
+    conn.executemany(
+        "INSERT INTO banter (source, type, body) VALUES (?, ?, ?)",
+        [(relative_path, banter.get("type", banter_type),
+          json.dumps(banter, ensure_ascii=False)) for banter in banter_array])
+    return len(banter_array)
+
+
+def _drop_source(conn, relative_path):
+    conn.execute("DELETE FROM question_tags WHERE question IN"
+                 " (SELECT id FROM questions WHERE source = ?)",
+                 (relative_path,))
+    conn.execute("DELETE FROM questions WHERE source = ?", (relative_path,))
+    conn.execute("DELETE FROM banter WHERE source = ?", (relative_path,))
+
+
+def _rebuild_postings(conn):
+    conn.execute("DELETE FROM postings")
+    queries = {
+        "category": "SELECT category, id FROM questions"
+                    " WHERE category IS NOT NULL ORDER BY id",
+        "lang": "SELECT lang, id FROM questions"
+                " WHERE lang IS NOT NULL ORDER BY id",
+        "tag": "SELECT tag, question FROM question_tags ORDER BY question",
+    }
+    for kind, query in queries.items():
+        postings = {}
+        for value, question_id in conn.execute(query):
+            postings.setdefault(value, array("I")).append(question_id)
+        conn.executemany(
+            "INSERT INTO postings VALUES (?, ?, ?)",
+            [(kind, value, ids.tobytes()) for value, ids in postings.items()])
+
+
+def build_pack(pack_path=DEFAULT_PACK_PATH, root=REPO_ROOT):
+    """Compiles the question and banter files into a single SQLite pack.
+
+    Only files whose size, mtime and then content hash changed since the
+    last build are reparsed.
+    Returns:
+      A (rebuilt, unchanged) tuple of file counts.
+    """
+
+    conn = sqlite3.connect(pack_path)
+    conn.executescript(_SCHEMA)
+    strings = dict(conn.execute("SELECT value, id FROM strings"))
+    known = {path: (size, mtime_ns, sha1) for path, size, mtime_ns, sha1
+             in conn.execute("SELECT * FROM sources")}
+
+    sources = [(filename, False) for filename in question_files(root)]
+    sources.extend((os.path.join(root, name), True) for name in BANTER_FILES
+                   if os.path.exists(os.path.join(root, name)))
+    rebuilt = unchanged = 0
+    seen = set()
+    for filename, is_banter in sources:
+        relative_path = os.path.relpath(filename, root)
+        seen.add(relative_path)
+        stat = os.stat(filename)
+        previous = known.get(relative_path)
+        if previous and previous[:2] == (stat.st_size, stat.st_mtime_ns):
+            unchanged += 1
+            continue
+        sha1 = file_sha1(filename)
+        if not (previous and previous[2] == sha1):
+            _drop_source(conn, relative_path)
+            if is_banter:
+                count = _load_banter(conn, filename, relative_path)
+            else:
+                count = _load_questions(conn, strings, filename, relative_path)
+            logger.info('Packed %s entries from %s', count, relative_path)
+            rebuilt += 1
+        else:
+            unchanged += 1
+        conn.execute("INSERT OR REPLACE INTO sources VALUES (?, ?, ?, ?)",
+                     (relative_path, stat.st_size, stat.st_mtime_ns, sha1))
+
+    for relative_path in set(known) - seen:
+        logger.info('Dropping %s from the pack', relative_path)
+        _drop_source(conn, relative_path)
+        conn.execute("DELETE FROM sources WHERE path = ?", (relative_path,))
+        rebuilt += 1
+
+    if rebuilt:
+        _rebuild_postings(conn)
+    conn.commit()
+    conn.close()
+    return rebuilt, unchanged
+
+
+class QuestionPack:
+    """Read-only view of a pack built by build_pack"""
+
+    def __init__(self, pack_path=DEFAULT_PACK_PATH):
+        self._conn = sqlite3.connect(
+            "file:%s?mode=ro" % pack_path, uri=True, check_same_thread=False)
+        self._conn.execute("PRAGMA mmap_size = 268435456")
+        self._strings = dict(self._conn.execute("SELECT value, id FROM strings"))
+
+    def values(self, kind):
+        """Returns the interned values that have a postings list of `kind`"""
+        ids = {row[0] for row in self._conn.execute(
+            "SELECT value FROM postings WHERE kind = ?", (kind,))}
+        return sorted(value for value, string_id in self._strings.items()
+                      if string_id in ids)
+
+    def postings(self, kind, value):
+        """Returns the sorted question ids for a category, lang or tag"""
+        ids = array("I")
+        string_id = self._strings.get(value)
+        if string_id is None:
+            return ids
+        row = self._conn.execute(
+            "SELECT ids FROM postings WHERE kind = ? AND value = ?",
+            (kind, string_id)).fetchone()
+        if row is not None:
+            ids.frombytes(row[0])
+        return ids
+
+    def question_ids(self):
+        ids = array("I")
+        ids.extend(row[0] for row in self._conn.execute(
+            "SELECT id FROM questions ORDER BY id"))
+        return ids
+
+    def column_ids(self, column, value):
+        """Returns the sorted question ids with `column` (difficulty or
+        status) equal to value"""
+        if column not in ("difficulty", "status"):
+            raise ValueError("Not a plain question column: " + column)
+        ids = array("I")
+        ids.extend(row[0] for row in self._conn.execute(
+            "SELECT id FROM questions WHERE %s = ? ORDER BY id" % column,
+            (value,)))
+        return ids
+
+    def banter_ids(self, banter_type):
+        ids = array("I")
+        ids.extend(row[0] for row in self._conn.execute(
+            "SELECT id FROM banter WHERE type = ? ORDER BY id",
+            (banter_type,)))
+        return ids
+
+    def get_banter(self, banter_id):
+        row = self._conn.execute(
+            "SELECT body FROM banter WHERE id = ?", (banter_id,)).fetchone()
+        if row is None:
+            raise KeyError(banter_id)
+        return json.loads(row[0])
+
+    def get(self, question_id):
+        """Returns the question dict for an id"""
+        row = self._conn.execute(
+            "SELECT body FROM questions WHERE id = ?", (question_id,)).fetchone()
+        if row is None:
+            raise KeyError(question_id)
+        return json.loads(row[0])
+
+    def close(self):
+        self._conn.close()
+
@@ -0,0 +1,92 @@
+import logging
+import random
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+WINDOW_SECONDS = 60.0
+
+
+class RateLimiter:
+    """Sliding-window limiter for requests and tokens per minute.
+
+    A limit of 0 disables that check. Safe to share between threads.
+    """
+
+    def __init__(self, requests_per_minute=0, tokens_per_minute=0):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._lock = threading.Lock()
+        self._window = deque()
+        self._window_tokens = 0
+
+    def _prune(self, now):
+        while self._window and now - self._window[0][0] >= WINDOW_SECONDS:
+            _, tokens = self._window.popleft()
+            self._window_tokens -= tokens
+
+    def _has_room(self, tokens):
+        if not self._window:
+            # always let a single request through, even if it alone is
+            # bigger than the token budget
+            return True
+        if (self.requests_per_minute
+                and len(self._window) >= self.requests_per_minute):
+            return False
+        if (self.tokens_per_minute
+                and self._window_tokens + tokens > self.tokens_per_minute):
+            return False
+        return True
+
+    def acquire(self, tokens=0):
+        """Blocks until a request of `tokens` tokens fits in the window.
+        Args:
+          tokens: Estimated prompt + completion tokens for the request.
+        """
+
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._prune(now)
+                if self._has_room(tokens):
+                    self._window.append((now, tokens))
+                    self._window_tokens += tokens
+                    return
+                wait = WINDOW_SECONDS - (now - self._window[0][0])
+            logger.debug('Rate limit reached, waiting %.1fs', wait)
+            time.sleep(max(wait, 0.05))
+
+
+def backoff_delay(attempt, base_delay=1.0, max_delay=60.0):
+    """Seconds to wait before retry number `attempt` + 1"""
+    # full jitter keeps concurrent workers from retrying in lockstep
+    return random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+
+
+def call_with_retries(call, retry_on, max_retries=5, base_delay=1.0,
+                      max_delay=60.0):
+    """Calls `call()` and retries with exponential backoff.
+    Args:
+      call: Zero-argument function to invoke.
+      retry_on: Exception class (or tuple) that should trigger a retry.
+      max_retries: Retries after the first attempt before giving up.
+      base_delay: Delay in seconds before the first retry.
+      max_delay: Upper bound for a single delay.
+    Returns:
+      Whatever `call()` returns.
+    """
+
+    attempt = 0
+    while True:
+        try:
+            return call()
+        except retry_on as err:
+            if attempt >= max_retries:
+                raise
+            delay = backoff_delay(attempt, base_delay, max_delay)
+            attempt += 1
+            logger.warning('Retry %s/%s in %.1fs after error: %s',
+                           attempt, max_retries, delay, err)
+            time.sleep(delay)
@@ -0,0 +1,208 @@
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+from array import array
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+INDEX_SUFFIX = ".idx"
+_INDEX_MAGIC = b"OTDBIDX1"
+# magic, source size, source mtime in ns
+_INDEX_HEADER = struct.Struct("<8sQQ")
+_OFFSET = struct.Struct("<Q")
+_CHUNK_SIZE = 1 << 20
+
+# A question parsed from a file, with its 1-based line number and the
+# byte offset where that line starts.
+Record = namedtuple("Record", ["line_number", "offset", "question"])
+# A line that should have held a question but could not be parsed.
+Malformed = namedtuple("Malformed", ["line_number", "offset", "line", "error"])
+
+# Lines that only open or close the JSON array
+_STRUCTURAL_LINES = {"", "[", "]", "],"}
+
+
+def parse_json_line(line):
+    """Parses a line of text into JSON and returns the result.
+    Args:
+      line: The line of text to parse, with or without a trailing comma
+        and line ending.
+    Returns:
+      A JSON object or None if the line could not be parsed.
+    """
+
+    line = line.strip()
+    # chomp last comma
+    if line.endswith(","):
+        line = line[:-1]
+    try:
+        json_object = json.loads(line)
+    except json.JSONDecodeError:
+        return None
+    if not isinstance(json_object, dict):
+        return None
+    return json_object
+
+
+def is_structural(line):
+    """True for blank lines and the lines that open/close the array"""
+    return line.strip() in _STRUCTURAL_LINES
+
+
+def index_path(filename):
+    return filename + INDEX_SUFFIX
+
+
+def _source_stamp(filename):
+    stat = os.stat(filename)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def build_index(filename):
+    """Writes a sidecar file with the byte offset of every line.
+    Returns:
+      The path of the index file.
+    """
+
+    offsets = array("Q", [0])
+    position = 0
+    with open(filename, "rb") as file:
+        for chunk in iter(lambda: file.read(_CHUNK_SIZE), b""):
+            newline = chunk.find(b"\n")
+            while newline != -1:
+                offsets.append(position + newline + 1)
+                newline = chunk.find(b"\n", newline + 1)
+            position += len(chunk)
+    if offsets[-1] == position:
+        # no line starts at end of file
+        offsets.pop()
+    if sys.byteorder != "little":
+        offsets.byteswap()
+
+    size, mtime_ns = _source_stamp(filename)
+    path = index_path(filename)
+    with open(path + ".tmp", "wb") as file:
+        file.write(_INDEX_HEADER.pack(_INDEX_MAGIC, size, mtime_ns))
+        file.write(offsets.tobytes())
+    os.replace(path + ".tmp", path)
+    logger.debug('Indexed %s lines of %s', len(offsets), filename)
+    return path
+
+
+class OffsetIndex:
+    """Memory-mapped view of a sidecar line offset index"""
+
+    def __init__(self, filename):
+        self._file = open(index_path(filename), "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.size, self.mtime_ns = _INDEX_HEADER.unpack_from(self._map)
+        if magic != _INDEX_MAGIC:
+            self.close()
+            raise ValueError("Not a line index: " + index_path(filename))
+
+    def __len__(self):
+        return (len(self._map) - _INDEX_HEADER.size) // _OFFSET.size
+
+    def offset(self, line_index):
+        """Byte offset of the 0-based line `line_index`"""
+        if not 0 <= line_index < len(self):
+            raise IndexError(line_index)
+        return _OFFSET.unpack_from(
+            self._map, _INDEX_HEADER.size + line_index * _OFFSET.size)[0]
+
+    def is_fresh(self, filename):
+        return (self.size, self.mtime_ns) == _source_stamp(filename)
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+
+def open_index(filename, build=True):
+    """Returns an up-to-date OffsetIndex for filename, or None.
+    Args:
+      filename: The question file.
+      build: (Re)build the sidecar if it is missing or stale.
+    """
+
+    try:
+        index = OffsetIndex(filename)
+        if index.is_fresh(filename):
+            return index
+        index.close()
+    except (OSError, ValueError, struct.error):
+        pass
+    if not build:
+        return None
+    build_index(filename)
+    return OffsetIndex(filename)
+
+
+def iter_lines(filename, start=0, use_index=False):
+    """Streams the lines of a file without loading it into memory.
+    Args:
+      filename: The file to read.
+      start: 0-based index of the first line to yield.
+      use_index: Seek to `start` with the sidecar index instead of
+        scanning the lines before it.
+    Yields:
+      (line_number, offset, text) with a 1-based line number, the byte
+      offset of the line and its text without the line ending.
+    """
+
+    with open(filename, "rb") as file:
+        line_index = 0
+        position = 0
+        if start > 0 and use_index:
+            index = open_index(filename)
+            try:
+                if start >= len(index):
+                    return
+                position = index.offset(start)
+            finally:
+                index.close()
+            file.seek(position)
+            line_index = start
+        for raw_line in file:
+            if line_index >= start:
+                text = raw_line.decode("utf-8").rstrip("\r\n")
+                yield line_index + 1, position, text
+            line_index += 1
+            position += len(raw_line)
+
+
+def iter_questions(filename, start=0, use_index=False, on_malformed=None):
+    """Streams the questions of a one-object-per-line question file.
+    Args:
+      filename: The question file.
+      start: 0-based index of the first line to read.
+      use_index: Seek to `start` with the sidecar index.
+      on_malformed: Called with a Malformed tuple for each line that
+        could not be parsed; by default they are logged.
+    Yields:
+      Record tuples.
+    """
+
+    for line_number, offset, text in iter_lines(filename, start, use_index):
+        if is_structural(text):
+            continue
+        question = parse_json_line(text)
+        if question is not None:
+            yield Record(line_number, offset, question)
+            continue
+        malformed = Malformed(line_number, offset, text, "invalid JSON object")
+        if on_malformed is None:
+            logger.warning('%s:%s: %s', filename, line_number, malformed.error)
+        else:
+            on_malformed(malformed)
+
+
+def read_line(filename, line_index):
+    """Returns the text of the 0-based line `line_index` with one seek"""
+    for _, _, text in iter_lines(filename, line_index, use_index=True):
+        return text
+    raise IndexError(line_index)
@@ -0,0 +1,133 @@
+import argparse
+import random
+import time
+from array import array
+
+from pack import DEFAULT_PACK_PATH, QuestionPack
+
+# Filters answered by a postings list in the pack, and the kind they use
+_POSTING_FILTERS = {"category": "category", "tag": "tag", "lang": "lang"}
+_COLUMN_FILTERS = ("difficulty", "status")
+
+
+class Session:
+    """Draws without replacement, so a player never sees a repeat.
+
+    Each draw is one step of a Fisher-Yates shuffle over the candidate
+    ids: O(1) per draw with no rejection sampling.
+    """
+
+    def __init__(self, ids, fetch, rng):
+        self._ids = array(ids.typecode, ids)
+        self._remaining = len(self._ids)
+        self._fetch = fetch
+        self._rng = rng
+
+    def __len__(self):
+        return self._remaining
+
+    def draw_id(self):
+        if self._remaining == 0:
+            raise IndexError("session has no questions left")
+        pick = self._rng.randrange(self._remaining)
+        self._remaining -= 1
+        ids = self._ids
+        ids[pick], ids[self._remaining] = ids[self._remaining], ids[pick]
+        return ids[self._remaining]
+
+    def draw(self):
+        return self._fetch(self.draw_id())
+
+
+class Sampler:
+    """Uniform random questions and banter from a compiled question pack.
+
+    Candidate id lists are computed once per filter combination; every
+    draw after that is a single random index into the list.
+    """
+
+    def __init__(self, question_pack, rng=None):
+        self.pack = question_pack
+        self.rng = rng or random.Random()
+        self._candidates = {}
+        self._banter = {}
+
+    def candidates(self, category=None, tag=None, lang=None,
+                   difficulty=None, status=None):
+        """Returns the sorted ids matching every given filter"""
+        filters = {"category": category, "tag": tag, "lang": lang,
+                   "difficulty": difficulty, "status": status}
+        key = tuple(sorted((name, value) for name, value in filters.items()
+                           if value is not None))
+        if key in self._candidates:
+            return self._candidates[key]
+
+        matching = None
+        for name, value in key:
+            if name in _POSTING_FILTERS:
+                ids = self.pack.postings(_POSTING_FILTERS[name], value)
+            else:
+                ids = self.pack.column_ids(name, value)
+            matching = set(ids) if matching is None else matching & set(ids)
+        if matching is None:
+            ids = self.pack.question_ids()
+        else:
+            ids = array("I", sorted(matching))
+        self._candidates[key] = ids
+        return ids
+
+    def draw_id(self, **filters):
+        ids = self.candidates(**filters)
+        if not ids:
+            raise IndexError("no questions match %s" % filters)
+        return ids[self.rng.randrange(len(ids))]
+
+    def draw(self, **filters):
+        """Returns a uniformly random question matching the filters"""
+        return self.pack.get(self.draw_id(**filters))
+
+    def session(self, **filters):
+        """Returns a Session drawing matching questions without repeats"""
+        return Session(self.candidates(**filters), self.pack.get, self.rng)
+
+    def draw_banter(self, banter_type):
+        """Returns a uniformly random banter entry of the given type"""
+        if banter_type not in self._banter:
+            self._banter[banter_type] = self.pack.banter_ids(banter_type)
+        ids = self._banter[banter_type]
+        if not ids:
+            raise IndexError("no banter of type %s" % banter_type)
+        return self.pack.get_banter(ids[self.rng.randrange(len(ids))])
+
+
+def benchmark(pack_path=DEFAULT_PACK_PATH, draws=100000, **filters):
+    """Prints draws per second for ids, full questions and sessions"""
+    question_pack = QuestionPack(pack_path)
+    sampler = Sampler(question_pack)
+    print("candidates: %d" % len(sampler.candidates(**filters)))
+
+    def report(name, draw, count):
+        start = time.perf_counter()
+        for _ in range(count):
+            draw()
+        elapsed = time.perf_counter() - start
+        print("%-16s %12.0f draws/s" % (name, count / elapsed))
+
+    report("draw_id", lambda: sampler.draw_id(**filters), draws)
+    report("draw", lambda: sampler.draw(**filters), draws // 10)
+    session = sampler.session(**filters)
+    report("session.draw_id", session.draw_id, len(session))
+    report("draw_banter", lambda: sampler.draw_banter("trash"), draws // 10)
+    question_pack.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sampler microbenchmark")
+    parser.add_argument("--pack", default=DEFAULT_PACK_PATH)
+    parser.add_argument("--draws", default=100000, type=int)
+    parser.add_argument("--category")
+    parser.add_argument("--tag")
+    parser.add_argument("--lang")
+    args = parser.parse_args()
+    benchmark(args.pack, args.draws, category=args.category, tag=args.tag,
+              lang=args.lang)
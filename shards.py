@@ -0,0 +1,82 @@
+import glob
+import os
+from collections import Counter, namedtuple
+
+import reader
+
+DEFAULT_SHARD_LINES = 1000
+SUMMARY_FIELDS = ("read", "questions", "written", "skipped", "failed")
+
+# Lines first_line..last_line (1-based, inclusive) of a question file.
+# whole_file: the shard covers the file, so its outputs keep the plain
+# <file>.out/.problems names.
+Shard = namedtuple("Shard", ["filename", "first_line", "last_line",
+                             "whole_file"])
+
+
+def expand(pattern):
+    """Returns the question files for a glob or a directory"""
+    if os.path.isdir(pattern):
+        pattern = os.path.join(pattern, "*.json")
+    return sorted(glob.glob(pattern))
+
+
+def plan(filenames, shard_lines=DEFAULT_SHARD_LINES):
+    """Splits question files into shards of at most `shard_lines` lines.
+
+    The first line of every file only opens the JSON array and is never
+    part of a shard. Shards come back largest first, so the long ones
+    start early and don't hold up the end of the run.
+    """
+
+    shard_lines = max(1, shard_lines)
+    shards = []
+    for filename in filenames:
+        index = reader.open_index(filename)
+        line_count = len(index)
+        index.close()
+        if line_count < 2:
+            continue
+        if line_count - 1 <= shard_lines:
+            shards.append(Shard(filename, 2, line_count, True))
+            continue
+        for first_line in range(2, line_count + 1, shard_lines):
+            shards.append(Shard(
+                filename, first_line,
+                min(first_line + shard_lines - 1, line_count), False))
+    shards.sort(key=lambda shard: shard.last_line - shard.first_line,
+                reverse=True)
+    return shards
+
+
+def category(filename):
+    """en/todo/music.json -> music"""
+    return os.path.splitext(os.path.basename(filename))[0]
+
+
+def merge(results):
+    """Adds up per-shard counts by category
+    Args:
+      results: (Shard, Counter) pairs.
+    Returns:
+      A dict of category to Counter, sorted by category.
+    """
+
+    totals = {}
+    for shard, counts in results:
+        totals.setdefault(category(shard.filename), Counter()).update(counts)
+    return dict(sorted(totals.items()))
+
+
+def format_summary(totals):
+    """Renders merged counts as a fixed-width table with a total row"""
+    rows = ["%-24s" % "category" + "".join(
+        "%11s" % field for field in SUMMARY_FIELDS)]
+    overall = Counter()
+    for name, counts in totals.items():
+        overall.update(counts)
+        rows.append("%-24s" % name + "".join(
+            "%11d" % counts[field] for field in SUMMARY_FIELDS))
+    rows.append("%-24s" % "total" + "".join(
+        "%11d" % overall[field] for field in SUMMARY_FIELDS))
+    return "\n".join(rows)
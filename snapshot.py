@@ -0,0 +1,284 @@
+import datetime
+import json
+import logging
+import os
+import re
+import shutil
+
+import backends
+import reader
+from metrics import METRICS
+from store import UPDATED_FIELD
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SNAPSHOT_DIR = "snapshot"
+MANIFEST_FILE = "manifest.json"
+SHARD_SUFFIX = ".jsonl"
+# Firestore document id, stored next to the fields of each document
+ID_FIELD = "_id"
+# Shard of documents without a value in the shard field
+UNSHARDED = "ALL"
+SYNC_PAGE_SIZE = 500
+# How far before the start of a sync its watermark goes: writes that
+# commit while a sync runs, and clock skew, fall in this window
+WATERMARK_SLACK = datetime.timedelta(minutes=5)
+
+
+def _encode(value):
+    # Firestore timestamps come back as datetimes
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    return str(value)
+
+
+def _dumps(document_id, data):
+    return json.dumps(dict(data, **{ID_FIELD: document_id}),
+                      ensure_ascii=False, default=_encode)
+
+
+def _shard_name(value):
+    if not isinstance(value, str) or not value:
+        return UNSHARDED
+    return re.sub(r"[^A-Za-z0-9_-]", "_", value)
+
+
+def collection_dir(directory, collection):
+    return os.path.join(directory, collection)
+
+
+def load_manifest(directory):
+    """Returns {collection: sync state} for a snapshot directory"""
+    try:
+        with open(os.path.join(directory, MANIFEST_FILE)) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+
+
+def _save_manifest(directory, manifest):
+    path = os.path.join(directory, MANIFEST_FILE)
+    with open(path + ".tmp", "w") as file:
+        json.dump(manifest, file, indent=1, sort_keys=True)
+    os.replace(path + ".tmp", path)
+
+
+def iter_documents(directory, collection, shard=None):
+    """Streams (document id, data) pairs from a snapshot.
+    Args:
+      directory: The snapshot directory.
+      collection: Name of the synced collection.
+      shard: Only read the shard for this value of the shard field.
+    """
+
+    path = collection_dir(directory, collection)
+    if shard is not None:
+        filenames = [os.path.join(path, _shard_name(shard) + SHARD_SUFFIX)]
+    else:
+        filenames = sorted(
+            os.path.join(path, name) for name in os.listdir(path)
+            if name.endswith(SHARD_SUFFIX)) if os.path.isdir(path) else []
+    for filename in filenames:
+        if not os.path.exists(filename):
+            continue
+        for record in reader.iter_questions(filename):
+            data = record.question
+            yield data.pop(ID_FIELD, None), data
+
+
+def find(directory, collection, where=None, shard=None):
+    """Returns the (document id, data) pairs whose fields equal every
+    value in `where`, in document id order like an `__name__` query"""
+    where = where or {}
+    # like Firestore, False doesn't match 0
+    return sorted(
+        ((document_id, data) for document_id, data
+         in iter_documents(directory, collection, shard)
+         if all(field in data and data[field] == value
+                and type(data[field]) is type(value)
+                for field, value in where.items())),
+        key=lambda item: item[0])
+
+
+def get_documents(directory, collection, document_ids):
+    """Returns {document id: data} for the ids found in a snapshot"""
+    wanted = set(document_ids)
+    found = {}
+    if not wanted:
+        return found
+    for document_id, data in iter_documents(directory, collection):
+        if document_id in wanted:
+            found[document_id] = data
+    return found
+
+
+def _fetch(db, collection, since, page_size):
+    """Yields pages of document snapshots, changed at or after `since`"""
+    query = db.collection(collection)
+    if since is None:
+        query = query.order_by("__name__")
+    else:
+        # >= rather than >: writes that share the watermark's timestamp
+        # are fetched again instead of missed
+        query = (query
+                 .where(filter=backends.field_filter(UPDATED_FIELD, ">=",
+                                                     since))
+                 .order_by(UPDATED_FIELD))
+    query = query.limit(page_size)
+    cursor = None
+    while True:
+        page = query if cursor is None else query.start_after(cursor)
+        with METRICS.timer("firestore_read_seconds"):
+            snapshots = list(page.stream())
+        METRICS.count("firestore_reads", len(snapshots))
+        if not snapshots:
+            return
+        yield snapshots
+        if len(snapshots) < page_size:
+            return
+        cursor = snapshots[-1]
+
+
+def _latest(latest, data):
+    updated = data.get(UPDATED_FIELD)
+    if isinstance(updated, datetime.datetime) and (
+            latest is None or updated > latest):
+        return updated
+    return latest
+
+
+def _export(db, directory, collection, shard_field, page_size):
+    """Writes every document into fresh shards, replacing the old ones.
+    Returns the number of documents and the latest update time seen."""
+
+    path = collection_dir(directory, collection)
+    temp_path = path + ".tmp"
+    shutil.rmtree(temp_path, ignore_errors=True)
+    os.makedirs(temp_path)
+    files = {}
+    documents = 0
+    latest = None
+    try:
+        for snapshots in _fetch(db, collection, None, page_size):
+            for snapshot in snapshots:
+                data = snapshot.to_dict()
+                name = _shard_name(data.get(shard_field))
+                if name not in files:
+                    files[name] = open(
+                        os.path.join(temp_path, name + SHARD_SUFFIX), "w",
+                        encoding="utf-8")
+                files[name].write(_dumps(snapshot.id, data) + "\n")
+                documents += 1
+                latest = _latest(latest, data)
+    finally:
+        for file in files.values():
+            file.close()
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(temp_path, path)
+    return documents, latest
+
+
+def _apply_changes(path, changes, shard_field):
+    """Rewrites the shards that hold or gain a changed document.
+    Returns the number of changed documents the snapshot had already."""
+
+    os.makedirs(path, exist_ok=True)
+    if not changes:
+        return 0
+    by_shard = {}
+    for document_id, data in changes.items():
+        by_shard.setdefault(_shard_name(data.get(shard_field)), []).append(
+            (document_id, data))
+    names = {name[:-len(SHARD_SUFFIX)] for name in os.listdir(path)
+             if name.endswith(SHARD_SUFFIX)}
+    replaced = 0
+    for name in sorted(names | set(by_shard)):
+        filename = os.path.join(path, name + SHARD_SUFFIX)
+        changed = name in by_shard
+        with open(filename + ".tmp", "w", encoding="utf-8") as out:
+            if os.path.exists(filename):
+                with open(filename, encoding="utf-8") as file:
+                    for line in file:
+                        document = reader.parse_json_line(line)
+                        if (document is not None
+                                and document.get(ID_FIELD) in changes):
+                            # the new version goes to the shard it is in now
+                            changed = True
+                            replaced += 1
+                            continue
+                        out.write(line)
+            for document_id, data in by_shard.get(name, ()):
+                out.write(_dumps(document_id, data) + "\n")
+        if changed:
+            os.replace(filename + ".tmp", filename)
+        else:
+            os.remove(filename + ".tmp")
+    return replaced
+
+
+def sync(db, directory, collection, shard_field=None, full=False,
+         page_size=SYNC_PAGE_SIZE):
+    """Brings the local snapshot of a collection up to date.
+
+    The first sync, and any sync with `full`, exports the whole
+    collection. Later syncs only fetch documents whose UPDATED_FIELD is
+    at or after the watermark of the previous sync, so documents that
+    never had the field, and deletions, only show up in a full sync.
+    Args:
+      db: Firestore client (or fake).
+      directory: The snapshot directory.
+      collection: Name of the collection to sync.
+      shard_field: Field whose value picks the JSONL file of a document,
+        e.g. category_id; None keeps the collection in one file.
+      full: Export everything even if there is a watermark.
+      page_size: Documents per Firestore query.
+    Returns:
+      The number of documents fetched from Firestore.
+    """
+
+    os.makedirs(directory, exist_ok=True)
+    manifest = load_manifest(directory)
+    state = manifest.get(collection)
+    started = datetime.datetime.now(datetime.timezone.utc)
+    since = None
+    if state and state.get("watermark") and not full:
+        since = datetime.datetime.fromisoformat(state["watermark"])
+
+    if since is None:
+        logger.info('Exporting all of %s to %s', collection, directory)
+        fetched, latest = _export(db, directory, collection, shard_field,
+                                  page_size)
+        documents = fetched
+    else:
+        logger.info('Syncing %s changes since %s', collection,
+                    since.isoformat())
+        changes = {}
+        latest = None
+        for snapshots in _fetch(db, collection, since, page_size):
+            for snapshot in snapshots:
+                data = snapshot.to_dict()
+                changes[snapshot.id] = data
+                latest = _latest(latest, data)
+        fetched = len(changes)
+        replaced = _apply_changes(collection_dir(directory, collection),
+                                  changes, shard_field)
+        documents = state.get("documents", 0) + fetched - replaced
+
+    # the next sync starts a little before this one did, but never after
+    # the newest write the server reported or before the last watermark
+    watermark = started - WATERMARK_SLACK
+    if latest is not None:
+        watermark = min(watermark, latest)
+    if since is not None:
+        watermark = max(watermark, since)
+    manifest[collection] = {
+        "watermark": watermark.isoformat(),
+        "documents": documents,
+        "synced": started.isoformat(),
+        "full": since is None,
+    }
+    _save_manifest(directory, manifest)
+    METRICS.count("snapshot_documents_fetched", fetched)
+    logger.info('Fetched %s documents of %s, snapshot has %s', fetched,
+                collection, documents)
+    return fetched
@@ -0,0 +1,105 @@
+import logging
+
+import backends
+from metrics import METRICS
+
+logger = logging.getLogger(__name__)
+
+# Firestore rejects batched writes with more than 500 operations
+FIRESTORE_MAX_BATCH = 500
+# Server time of the last write to a trivia document; incremental
+# snapshot syncs fetch the documents changed since the previous sync
+UPDATED_FIELD = "updated"
+
+
+class QuestionWriter:
+    """Buffers new trivia documents and commits them as batched writes.
+
+    Existence checks for a group of documents are done with a single
+    `get_all` round trip instead of one `get()` per document. `db` is
+    anything with the `collection`, `get_all` and `batch` methods of a
+    Firestore client, so the emulator or an in-memory fake work too.
+    """
+
+    def __init__(self, db, collection="trivia", flush_size=FIRESTORE_MAX_BATCH):
+        self.db = db
+        self.collection = db.collection(collection)
+        self.flush_size = max(1, min(flush_size, FIRESTORE_MAX_BATCH))
+        self.written = 0
+        self.skipped = 0
+        # documents ever queued; commits land in queue order, so every
+        # document queued before written reached this count is stored
+        self.queued = 0
+        self._batch = None
+        self._batch_size = 0
+        # keys written (or queued) by this writer, so repeated questions
+        # in a run don't need another round trip
+        self._seen = set()
+
+    def add_all(self, questions):
+        """Queues questions that are not in the collection yet.
+        Args:
+          questions: Question dicts, each with a "content_id" key.
+        Returns:
+          The number of questions queued for writing.
+        """
+
+        candidates = []
+        for question in questions:
+            key = question["content_id"]
+            if key in self._seen:
+                logger.debug('Already found entry with key %s', key)
+                METRICS.count("skipped_duplicates")
+                self.skipped += 1
+                continue
+            self._seen.add(key)
+            candidates.append(question)
+        if not candidates:
+            return 0
+
+        refs = [self.collection.document(question["content_id"])
+                for question in candidates]
+        with METRICS.timer("firestore_read_seconds"):
+            existing = {snapshot.id
+                        for snapshot in self.db.get_all(refs)
+                        if snapshot.exists}
+        METRICS.count("firestore_reads", len(refs))
+
+        queued = 0
+        for ref, question in zip(refs, candidates):
+            if question["content_id"] in existing:
+                logger.debug('Already found entry with key %s',
+                             question["content_id"])
+                METRICS.count("skipped_duplicates")
+                self.skipped += 1
+                continue
+            logger.debug("Adding question to database: '%s'",
+                         question["question"])
+            if self._batch is None:
+                self._batch = self.db.batch()
+            document = dict(question)
+            document[UPDATED_FIELD] = backends.server_timestamp(self.db)
+            self._batch.set(ref, document)
+            self._batch_size += 1
+            self.queued += 1
+            queued += 1
+            if self._batch_size >= self.flush_size:
+                self.flush()
+        return queued
+
+    @property
+    def pending(self):
+        """Number of queued documents that are not committed yet"""
+        return self._batch_size
+
+    def flush(self):
+        """Commits any queued writes"""
+        if self._batch is None:
+            return
+        with METRICS.timer("firestore_write_seconds"):
+            self._batch.commit()
+        METRICS.count("firestore_writes", self._batch_size)
+        logger.debug('Committed %s documents', self._batch_size)
+        self.written += self._batch_size
+        self._batch = None
+        self._batch_size = 0
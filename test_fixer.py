@@ -0,0 +1,239 @@
+import json
+
+import pytest
+
+import fakes
+import fixer
+import journal
+import reader
+
+QUESTIONS = 24
+
+
+class Crash(BaseException):
+    """Stands in for the process dying; not caught by the error handling"""
+
+
+class CrashingChat(fakes.FakeChat):
+    """FakeChat that dies on the call after `calls` completions"""
+
+    def __init__(self, calls):
+        super().__init__()
+        self.calls = calls
+
+    def complete(self, **request):
+        if self.calls == 0:
+            raise Crash()
+        self.calls -= 1
+        return super().complete(**request)
+
+
+def _line(number):
+    return "  " + json.dumps({
+        "category_id": "MATHEMATICS", "lang": "en", "tags": ["MATHEMATICS"],
+        "question": "What is %s + %s?" % (number, number), "answer": 0,
+        "answers": [str(2 * number)]})
+
+
+def _items(count):
+    """(line, key, line number) items, as process_file batches them"""
+    return [(_line(number), str(number), number + 2)
+            for number in range(count)]
+
+
+@pytest.fixture
+def todo_file(tmp_path, monkeypatch):
+    # the journal, .out and .problems files go to the working directory
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "en" / "todo").mkdir(parents=True)
+    path = tmp_path / "en" / "todo" / "mathematics.json"
+    with open(path, "w") as file:
+        file.write("[\n")
+        file.write(",\n".join(_line(number) for number in range(QUESTIONS)))
+        file.write("\n]\n")
+    return str(path)
+
+
+def _run(filename, chat, db, *options):
+    fixer.use_backends(db, chat, chat)
+    args = fixer.build_parser().parse_args(
+        ["--filename", filename, "--limit", "1000", "--concurrency", "1",
+         "--no-cache", "--index", "index.sqlite3"] + list(options))
+    return fixer.process_file(args, None)
+
+
+def _done_lines(filename):
+    return set().union(*(entry.get("lines", ())
+                         for entry in journal.load(
+                             journal.journal_path(filename))))
+
+
+def test_crash_journals_only_committed_lines(todo_file):
+    db = fakes.FakeFirestore()
+    # about four lines per batch, five documents per write
+    options = ("--batch-tokens", "400", "--flush-size", "5")
+    with pytest.raises(Crash):
+        _run(todo_file, CrashingChat(calls=3), db, *options)
+
+    stored = len(db._documents("trivia"))
+    assert 0 < stored < QUESTIONS
+    # every line the journal calls done has its question stored
+    assert len(_done_lines(todo_file)) <= stored
+
+    counts = _run(todo_file, fakes.FakeChat(), db, *options)
+    assert counts["read"] + len(_done_lines(todo_file)) >= QUESTIONS
+    assert len(db._documents("trivia")) == QUESTIONS
+    assert len(_done_lines(todo_file)) == QUESTIONS
+
+
+def test_nodb_run_leaves_its_lines_for_the_next_run(todo_file):
+    db = fakes.FakeFirestore()
+    _run(todo_file, fakes.FakeChat(), db, "--nodb", "--no-index")
+    assert _done_lines(todo_file) == set()
+
+    counts = _run(todo_file, fakes.FakeChat(), db)
+    assert counts["written"] == QUESTIONS
+
+
+def test_output_order_follows_input(todo_file):
+    # without --heuristics, which groups the output by prompt
+    _run(todo_file, fakes.FakeChat(), fakes.FakeFirestore(),
+         "--batch-tokens", "400")
+    with open(journal.output_name(todo_file) + ".out") as out_file:
+        answers = [json.loads(line.rstrip().rstrip(","))["answers"][0]
+                   for line in out_file if line.strip()]
+    assert answers == [str(2 * number) for number in range(QUESTIONS)]
+
+
+def test_journal_refuses_another_files_journal(todo_file, tmp_path):
+    other = tmp_path / "fr" / "todo" / "mathematics.json"
+    other.parent.mkdir(parents=True)
+    other.write_text("[\n]\n")
+    journal.Journal(journal.journal_path(todo_file), todo_file).close()
+
+    assert (journal.journal_path(todo_file)
+            != journal.journal_path(str(other)))
+    with pytest.raises(ValueError):
+        journal.Journal(journal.journal_path(todo_file), str(other))
+
+
+class CountingChat(fakes.FakeChat):
+    """FakeChat that counts its completions and can reshape them"""
+
+    def __init__(self, reshape=None):
+        super().__init__()
+        self.calls = 0
+        self.reshape = reshape
+
+    def _respond(self, messages, max_tokens):
+        text, prompt_tokens, completion_tokens, finish_reason = (
+            super()._respond(messages, max_tokens))
+        if self.reshape is not None:
+            text = self.reshape(text)
+        return text, prompt_tokens, completion_tokens, finish_reason
+
+    def complete(self, **request):
+        self.calls += 1
+        return super().complete(**request)
+
+
+def _complete(chat, batch):
+    fixer.use_backends(chat=chat)
+    return fixer.complete_packed(batch, fixer.RateLimiter(0, 0), 0)
+
+
+def test_take_batch_packs_lines_up_to_the_budget():
+    buffer = _items(10)
+    tokens = fixer.expected_output_tokens(buffer[0][0])
+
+    assert fixer.take_batch(buffer, tokens * 20) == (None, 0)
+    batch, expected = fixer.take_batch(buffer, tokens * 4 + 1)
+    assert [number for _, _, number in batch] == [2, 3, 4, 5]
+    assert expected == tokens * 4
+    # a line over budget on its own still gets a batch
+    batch, _ = fixer.take_batch(buffer, 1)
+    assert len(batch) == 1
+    batch, _ = fixer.take_batch(buffer, tokens * 20, final=True)
+    assert len(batch) == 5 and buffer == []
+
+
+def test_take_batch_stops_at_max_batch_lines():
+    buffer = _items(fixer.MAX_BATCH_LINES + 5)
+    batch, _ = fixer.take_batch(buffer, 10 ** 9)
+    assert len(batch) == fixer.MAX_BATCH_LINES
+
+
+def test_truncated_response_is_split_until_it_fits(monkeypatch):
+    batch = _items(8)
+    # room for about three answered lines per response
+    monkeypatch.setattr(fixer, "OPENAI_MAX_TOKENS", 3 * len(
+        fakes.FakeChat()._respond(
+            [{"content": "INPUT:\n" + batch[0][0]}], None)[0]) // 4)
+    chat = CountingChat()
+    response, failed = _complete(chat, batch)
+
+    assert failed == []
+    assert fixer.response_objects(response) == 8
+    assert chat.calls > 1
+
+
+def test_code_fence_around_the_answer_is_not_split():
+    chat = CountingChat(lambda text: "```json\n%s\n```" % text)
+    response, failed = _complete(chat, _items(8))
+
+    assert chat.calls == 1
+    assert failed == []
+    assert fixer.response_objects(response) == 8
+
+
+def test_lines_left_out_of_a_response_are_retried_or_failed():
+    # the model never answers "What is 5 + 5?"
+    chat = CountingChat(lambda text: "\n".join(
+        line for line in text.splitlines() if "5 + 5" not in line))
+    batch = _items(8)
+    response, failed = _complete(chat, batch)
+
+    assert [number for _, _, number in failed] == [7]
+    assert fixer.response_objects(response) == 7
+
+
+class CuttingChat(fakes.FakeChat):
+    """FakeChat whose first stream is cut after `lines` response lines,
+    with a line of chatter and a code fence in front of them"""
+
+    def __init__(self, lines):
+        super().__init__()
+        self.lines = lines
+        self.prompts = []
+
+    def stream(self, model, messages, temperature=None, max_tokens=None,
+               **request):
+        self.prompts.append(messages[-1]["content"])
+        text, _, _, finish_reason = self._respond(messages, max_tokens)
+        if len(self.prompts) > 1:
+            yield text, None
+            yield "", finish_reason
+            return
+        yield "Here are the fixed questions:\n```json\n", None
+        yield "".join(line + "\n"
+                      for line in text.splitlines()[:self.lines]), None
+        raise fakes.FakeRateLimitError("fake stream cut")
+
+
+def test_cut_stream_resumes_with_the_unanswered_lines(monkeypatch):
+    monkeypatch.setattr(fixer, "backoff_delay", lambda attempt: 0)
+    chat = CuttingChat(lines=3)
+    fixer.use_backends(chat=chat)
+    emitted = []
+    failed = fixer.stream_packed(_items(8), fixer.RateLimiter(0, 0), 2,
+                                 emit=emitted.append)
+
+    assert failed == []
+    answers = [reader.parse_json_line(line)["answers"][0]
+               for line in emitted
+               if reader.parse_json_line(line) is not None]
+    assert answers == [str(2 * number) for number in range(8)]
+    # the chatter and fence answer nothing: the retry starts at line four
+    assert "What is 2 + 2?" in chat.prompts[0]
+    assert "What is 2 + 2?" not in chat.prompts[1]
+    assert "What is 3 + 3?" in chat.prompts[1]
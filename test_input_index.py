@@ -0,0 +1,33 @@
+import input_index
+from input_index import InputIndex, question_key
+
+
+def _question(text, answer, content_id):
+    return {"question": text, "answers": [answer], "content_id": content_id}
+
+
+def test_record_batch_pairs_by_position_before_dropping_keyless_lines(
+        tmp_path):
+    index = InputIndex(str(tmp_path / "index.sqlite3"))
+    questions = [_question("Who wrote Hamlet?", "Shakespeare", "c1"),
+                 _question("Who painted Guernica?", "Picasso", "c2")]
+    # the middle line has no key, so the counts match only once it's
+    # dropped; it must not shift the third line onto the second question
+    input_index.record_batch(index, ["raw1", None, "raw3"], questions)
+
+    assert index.lookup(["raw1", "raw3"]) == {}
+    assert index.lookup([question_key(question) for question in questions]
+                        ) == {question_key(questions[0]): "c1",
+                              question_key(questions[1]): "c2"}
+    index.close()
+
+
+def test_record_batch_pairs_one_question_per_line(tmp_path):
+    index = InputIndex(str(tmp_path / "index.sqlite3"))
+    input_index.record_batch(
+        index, ["raw1", "raw2"],
+        [_question("Who wrote Hamlet?", "Shakespeare", "c1"),
+         _question("Who painted Guernica?", "Picasso", "c2")])
+
+    assert index.lookup(["raw1", "raw2"]) == {"raw1": "c1", "raw2": "c2"}
+    index.close()
@@ -0,0 +1,66 @@
+import json
+
+import neardup
+
+
+def _write_questions(path, questions):
+    with open(path, "w") as file:
+        file.write("[\n")
+        file.write(",\n".join(
+            "  " + json.dumps({"category_id": "GEOGRAPHY", "lang": "en",
+                              "question": question, "answer": 0,
+                              "answers": [answer]})
+            for question, answer in questions))
+        file.write("\n]\n")
+    return str(path)
+
+
+def _clustered(tmp_path, questions):
+    filename = _write_questions(tmp_path / "questions.json", questions)
+    return [[member.question for member in cluster]
+            for cluster in neardup.find_clusters([filename])]
+
+
+def test_same_template_with_other_answers_is_not_a_duplicate(tmp_path):
+    assert _clustered(tmp_path, [
+        ("Paris is the capital of ___", "France"),
+        ("Rome is the capital of ___", "Italy"),
+        ("Madrid is the capital of ___", "Spain"),
+        ("What is the first letter of the Greek alphabet", "Alpha"),
+        ("What is the last letter of the Greek alphabet", "Omega"),
+        ("What was the former name of Kampuchea", "Cambodia"),
+        ("What was the former name of Thailand", "Siam"),
+    ]) == []
+
+
+def test_same_answer_about_something_else_is_not_a_duplicate(tmp_path):
+    assert _clustered(tmp_path, [
+        ("What is the basic unit of currency for Australia ?", "Dollar"),
+        ("What is the basic unit of currency for Bahamas ?", "Dollar"),
+    ]) == []
+
+
+def test_rewordings_and_typos_are_duplicates_of_the_first(tmp_path):
+    assert _clustered(tmp_path, [
+        ("What is the capital of Croatia ?", "Zagreb"),
+        ("What is the capital of Ukraine ?", "Kiev"),
+        ("What is the capitla of Croatia?", "Zagreb"),
+        ("what is the capital of croatia", "zagreb"),
+    ]) == [["What is the capital of Croatia ?",
+            "What is the capitla of Croatia?",
+            "what is the capital of croatia"]]
+
+
+def test_casing_variants_of_the_kept_question_are_skipped(tmp_path):
+    filename = _write_questions(tmp_path / "questions.json", [
+        ("What is the capital of Croatia ?", "Zagreb"),
+        ("what is the capital of croatia", "zagreb"),
+        ("What is the capitla of Croatia?", "Zagreb"),
+    ])
+    clusters_path = str(tmp_path / "clusters.json")
+    neardup.write_clusters(neardup.find_clusters([filename]), clusters_path)
+
+    skipped = neardup.load_duplicate_lines(filename, clusters_path)
+    assert sorted(skipped) == [3, 4]
+    assert neardup.load_duplicate_lines(
+        str(tmp_path / "other.json"), clusters_path) == {}
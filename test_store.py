@@ -0,0 +1,60 @@
+import fakes
+from store import FIRESTORE_MAX_BATCH, UPDATED_FIELD, QuestionWriter
+
+
+def _questions(*content_ids):
+    return [{"content_id": content_id, "question": "Question %s?" % content_id,
+             "answers": ["Answer"]} for content_id in content_ids]
+
+
+def test_one_get_all_per_group():
+    db = fakes.FakeFirestore()
+    writer = QuestionWriter(db)
+
+    assert writer.add_all(_questions("a", "b", "c", "d")) == 4
+    # one existence check, nothing committed yet
+    assert db.round_trips == 1
+    assert writer.pending == 4
+    assert writer.written == 0
+
+
+def test_flushes_at_flush_size():
+    db = fakes.FakeFirestore()
+    writer = QuestionWriter(db, flush_size=3)
+
+    writer.add_all(_questions("a", "b", "c", "d", "e", "f", "g"))
+    assert writer.written == 6
+    assert writer.pending == 1
+    assert writer.queued == 7
+    assert len(db._documents("trivia")) == 6
+
+    writer.flush()
+    assert writer.written == 7
+    assert writer.pending == 0
+    assert set(db._documents("trivia")) == set("abcdefg")
+    assert all(UPDATED_FIELD in document
+               for document in db._documents("trivia").values())
+
+
+def test_flush_size_is_capped_at_the_firestore_batch_limit():
+    writer = QuestionWriter(fakes.FakeFirestore(), flush_size=10000)
+    assert writer.flush_size == FIRESTORE_MAX_BATCH
+
+
+def test_counts_written_and_skipped():
+    db = fakes.FakeFirestore()
+    db.preload("trivia", {"a": {"question": "Question a?"}})
+    writer = QuestionWriter(db)
+
+    # "a" is already stored, the second "b" repeats one from this run
+    assert writer.add_all(_questions("a", "b", "c")) == 2
+    assert writer.add_all(_questions("b", "d")) == 1
+    round_trips = db.round_trips
+    # every key was seen before: no existence check needed
+    assert writer.add_all(_questions("c", "d")) == 0
+    assert db.round_trips == round_trips
+    writer.flush()
+
+    assert writer.written == 3
+    assert writer.skipped == 4
+    assert db._documents("trivia")["a"] == {"question": "Question a?"}
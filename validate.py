@@ -0,0 +1,291 @@
+import json
+import logging
+import multiprocessing
+import os
+import re
+from collections import Counter, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import pack
+import reader
+from pack import REPO_ROOT
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_PATH = "validate_cache.json"
+# Bump when the rules change, so cached results are not reused
+RULES_VERSION = 1
+# Where passing todo records can be moved, by --promote value
+PROMOTE_TARGETS = ("need_review", "root")
+_UPPERCASE_TAG = re.compile(r"^[A-Z0-9]+(_[A-Z0-9]+)*$")
+
+Violation = namedtuple("Violation", ["line_number", "rule", "message"])
+# What check_file found in one file
+FileReport = namedtuple("FileReport", ["violations", "records", "passed"])
+
+
+def _answers(question_obj):
+    answers = question_obj.get("answers")
+    if not isinstance(answers, list) or len(answers) < 2:
+        return "needs more than one answer"
+    return None
+
+
+def _answer_index(question_obj):
+    answers = question_obj.get("answers")
+    answer = question_obj.get("answer")
+    # bool is an int, but true isn't an index
+    if (not isinstance(answer, int) or isinstance(answer, bool)
+            or not isinstance(answers, list)
+            or not 0 <= answer < len(answers)):
+        return "answer %r is not an index into answers" % (answer,)
+    return None
+
+
+def _source(question_obj):
+    source = question_obj.get("source")
+    if not isinstance(source, str) or not source.strip():
+        return "has no source"
+    return None
+
+
+def _tags(question_obj):
+    tags = question_obj.get("tags")
+    if (not isinstance(tags, list) or not tags
+            or not all(isinstance(tag, str) and tag for tag in tags)):
+        return "needs one or more tags"
+    return None
+
+
+def _category(question_obj):
+    category = question_obj.get("category_id")
+    if not isinstance(category, str) or not _UPPERCASE_TAG.match(category):
+        return "category_id %r is not an UPPERCASE_TAG" % (category,)
+    if category not in (question_obj.get("tags") or ()):
+        return "category_id %s is not one of the tags" % category
+    return None
+
+
+# Each returns a message if the question breaks the rule. Whether a
+# category is singular can't be told from its spelling, so only its form
+# is checked.
+RULES = (
+    ("answers", _answers),
+    ("answer_index", _answer_index),
+    ("source", _source),
+    ("tags", _tags),
+    ("category", _category),
+)
+
+
+def check_question(question_obj):
+    """Returns (rule, message) pairs for every rule a question breaks"""
+    violations = []
+    for name, rule in RULES:
+        message = rule(question_obj)
+        if message is not None:
+            violations.append((name, message))
+    return violations
+
+
+def check_line(text):
+    """Checks one raw line of a question file.
+    Returns:
+      None for lines that only open/close the array, else the question
+      (None if the line isn't a whole JSON object) and its violations.
+    """
+
+    if reader.is_structural(text):
+        return None
+    question_obj = reader.parse_json_line(text)
+    if question_obj is None:
+        return None, [("one_line", "not a complete JSON object on one line")]
+    return question_obj, check_question(question_obj)
+
+
+def check_file(filename):
+    """Streams a question file line by line and checks every record.
+    Returns:
+      A FileReport.
+    """
+
+    violations = []
+    records = passed = 0
+    for line_number, _, text in reader.iter_lines(filename):
+        result = check_line(text)
+        if result is None:
+            continue
+        records += 1
+        if not result[1]:
+            passed += 1
+        violations.extend(Violation(line_number, rule, message)
+                          for rule, message in result[1])
+    return FileReport(violations, records, passed)
+
+
+def _load_cache(cache_path):
+    try:
+        with open(cache_path) as file:
+            cache = json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+    if cache.get("rules_version") != RULES_VERSION:
+        return {}
+    return cache.get("files", {})
+
+
+def _save_cache(cache_path, files):
+    # write and rename so a crash never leaves a half-written file
+    with open(cache_path + ".tmp", "w") as file:
+        json.dump({"rules_version": RULES_VERSION, "files": files}, file)
+    os.replace(cache_path + ".tmp", cache_path)
+
+
+def validate(root=REPO_ROOT, cache_path=DEFAULT_CACHE_PATH, processes=4):
+    """Checks every question file under the language folders.
+
+    Files whose size and mtime, or else content hash, match the cache
+    are not read again; their cached violations are reported as is. The
+    others are checked in a pool of processes.
+    Returns:
+      {relative path: FileReport} for every file, in path order.
+    """
+
+    cached = _load_cache(cache_path)
+    files = {}
+    stale = []
+    for filename in pack.question_files(root):
+        relative_path = os.path.relpath(filename, root)
+        stat = os.stat(filename)
+        entry = cached.get(relative_path)
+        if entry and (entry["size"], entry["mtime_ns"]) == (
+                stat.st_size, stat.st_mtime_ns):
+            files[relative_path] = entry
+            continue
+        sha1 = pack.file_sha1(filename)
+        if entry and entry["sha1"] == sha1:
+            entry.update(size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+            files[relative_path] = entry
+            continue
+        files[relative_path] = {"size": stat.st_size,
+                                "mtime_ns": stat.st_mtime_ns, "sha1": sha1}
+        stale.append(relative_path)
+
+    logger.info('Checking %s changed files, %s unchanged', len(stale),
+                len(files) - len(stale))
+    if len(stale) > 1 and processes > 1:
+        # spawn, like the ingest pool: fork isn't safe once SDK clients exist
+        with ProcessPoolExecutor(
+                max_workers=min(processes, len(stale)),
+                mp_context=multiprocessing.get_context("spawn")) as executor:
+            reports = list(executor.map(
+                check_file, [os.path.join(root, path) for path in stale]))
+    else:
+        reports = [check_file(os.path.join(root, path)) for path in stale]
+    for relative_path, report in zip(stale, reports):
+        files[relative_path].update(
+            violations=[list(violation) for violation in report.violations],
+            records=report.records, passed=report.passed)
+
+    if stale or set(cached) != set(files):
+        _save_cache(cache_path, files)
+    return {
+        relative_path: FileReport(
+            [Violation(*violation) for violation in entry["violations"]],
+            entry["records"], entry["passed"])
+        for relative_path, entry in sorted(files.items())}
+
+
+def format_violations(reports):
+    """Yields "path:line: rule: message" lines for every violation"""
+    for relative_path, report in reports.items():
+        for violation in report.violations:
+            yield "%s:%s: %s: %s" % (relative_path, violation.line_number,
+                                     violation.rule, violation.message)
+
+
+def summarize(reports):
+    """Returns a Counter of records, passed records and violations by rule"""
+    counts = Counter()
+    for report in reports.values():
+        counts["records"] += report.records
+        counts["passed"] += report.passed
+        counts.update(violation.rule for violation in report.violations)
+    return counts
+
+
+def _object_line(text):
+    return "  " + text.strip().rstrip(",")
+
+
+def _read_entries(filename):
+    """Returns the non-structural lines of a question file, each with
+    whether it is a whole JSON object"""
+    if not os.path.exists(filename):
+        return []
+    return [(text, reader.parse_json_line(text) is not None)
+            for _, _, text in reader.iter_lines(filename)
+            if not reader.is_structural(text)]
+
+
+def _write_entries(filename, entries):
+    """Writes lines back as a JSON array, one object per line, with a
+    comma after every object but the last"""
+    last_object = max((number for number, (_, is_object)
+                       in enumerate(entries) if is_object), default=-1)
+    with open(filename + ".tmp", "w", encoding="utf-8") as file:
+        file.write("[\n")
+        for number, (text, is_object) in enumerate(entries):
+            if is_object:
+                text = _object_line(text) + ("," if number < last_object
+                                             else "")
+            file.write(text + "\n")
+        file.write("]\n")
+    os.replace(filename + ".tmp", filename)
+
+
+def promote_target(relative_path, target, root=REPO_ROOT):
+    """Returns where passing records of a todo file go, or None for files
+    that aren't in a todo folder"""
+    parts = relative_path.replace(os.sep, "/").split("/")
+    if len(parts) != 3 or parts[1] != "todo":
+        return None
+    lang, _, name = parts
+    if target == "root":
+        return os.path.join(root, lang, name)
+    return os.path.join(root, lang, target, name)
+
+
+def promote(reports, target, root=REPO_ROOT):
+    """Moves the records that pass every rule out of the todo files.
+
+    They are appended to the same file in `target` (need_review, or the
+    language root for "root"). The target is written before the todo
+    file, so a crash in between leaves a record in both rather than in
+    neither.
+    Returns:
+      The number of records moved.
+    """
+
+    moved = 0
+    for relative_path, report in reports.items():
+        destination = promote_target(relative_path, target, root)
+        if destination is None or not report.passed:
+            continue
+        filename = os.path.join(root, relative_path)
+        kept = []
+        passing = []
+        for text, is_object in _read_entries(filename):
+            if is_object and not check_line(text)[1]:
+                passing.append((text, True))
+            else:
+                kept.append((text, is_object))
+        if not passing:
+            continue
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        _write_entries(destination, _read_entries(destination) + passing)
+        _write_entries(filename, kept)
+        logger.info('Moved %s records from %s to %s', len(passing),
+                    relative_path, os.path.relpath(destination, root))
+        moved += len(passing)
+    return moved